@@ -5,14 +5,24 @@ Converts product descriptions into bag-of-words representations
 '''
 __author__='Charlie Guthrie'
 
+import string
+import zlib
+import multiprocessing
 import pandas as pd
 from keras.preprocessing.text import Tokenizer
 import cPickle as pkl
 import numpy as np
+import scipy.sparse
+from collections import OrderedDict
+import table_store
+import vocab
 
 #TODO: is it a problem that the dictionary includes the validation set?
 
-def build_tokenizer(series,nb_words,tok_path):
+#keras base_filter(): punctuation other than ' plus tab and newline become spaces
+DEFAULT_FILTERS = string.punctuation.replace("'",'') + '\t\n'
+
+def build_tokenizer(series,nb_words,tok_path,num_processes=1,counts=None):
     '''
     
     trains a bag-of-words model from a series
@@ -21,35 +31,239 @@ def build_tokenizer(series,nb_words,tok_path):
         nb_words: None or int. Maximum number of words to work with 
             (if set, tokenization will be restricted to the top nb_words most common words in the dataset)
         tok_path: path for saving the tokenizer
+        num_processes: worker processes for counting words
+        counts: vocab.WordCounts to add the series to, e.g. loaded from an
+            earlier run, so that only new products need counting
     returns:
-        idx: index list for tracking the words
-        text_matrix: bag of words matrix representation of text
-        dictionary: to identify columns
+        keras Tokenizer, as fit_on_texts would leave it but keeping only the
+        words it can use, and the WordCounts it was built from
     '''
     texts = series
-    tok = Tokenizer(nb_words=nb_words)
-    tok.fit_on_texts(texts)
+    new_counts = vocab.count_texts(texts,keras_words,num_processes)
+    if counts is None:
+        counts = new_counts
+    else:
+        counts.merge(new_counts)
+    tok = tokenizer_from_counts(counts,nb_words)
     with open(tok_path, 'wb') as outf:
         pkl.dump(tok,outf)
+    return tok,counts
+
+def tokenizer_from_counts(counts,nb_words=None):
+    '''
+    keras Tokenizer with its word counts and index set from a vocab.WordCounts
+    rather than by fit_on_texts.  Words tied on count are ordered by word.
+    With nb_words only the nb_words-1 words texts_to_matrix keeps are stored
+    '''
+    if nb_words:
+        counts = counts.prune(nb_words-1)
+    tok = Tokenizer(nb_words=nb_words)
+    tok.document_count = counts.n_docs
+    tok.word_counts = OrderedDict(counts.most_common())
+    tok.word_docs = dict(counts.doc_counts)
+    tok.word_index = counts.word_index()
+    tok.index_docs = dict((tok.word_index[w],c) for w,c in counts.doc_counts.iteritems())
     return tok
     
-def series_to_bag_of_words(series,tokenizer,text_matrix_path,mode="binary"):
+class Vectorizer(object):
+    '''
+    bag-of-words vectoriser over the vocabulary of a fitted keras Tokenizer,
+    giving the same values as tokenizer.texts_to_matrix but as a float32 CSR
+    matrix, without a dense row per document.  Texts that are not strings
+    (NaN descriptions) are empty documents.  tfidf is
+    (1 + log count) * log(1 + documents / (1 + documents with the word)),
+    the later keras 1.x formula; keras 1.0 gives log(count / length) instead
+    '''
+    MODES = ("binary","count","tfidf","freq")
+
+    def __init__(self,tokenizer):
+        self.set_filters(tokenizer.filters,tokenizer.lower,tokenizer.split)
+        if tokenizer.nb_words:
+            self.nb_words = tokenizer.nb_words
+        else:
+            self.nb_words = len(tokenizer.word_index)+1
+        #words past nb_words are dropped, as texts_to_sequences does
+        self.word_index = dict((w,i) for w,i in tokenizer.word_index.iteritems() if i<self.nb_words)
+        self.document_count = tokenizer.document_count
+        self.idf = None
+        if self.document_count:
+            index_docs = np.zeros(self.nb_words)
+            for i,n in getattr(tokenizer,'index_docs',{}).iteritems():
+                if i<self.nb_words:
+                    index_docs[i] = n
+            self.idf = np.log(1 + self.document_count/(1 + index_docs)).astype(np.float32)
+
+    def set_filters(self,filters,lower,split):
+        self.filters = filters
+        self.lower = lower
+        self.split = split
+        self.str_table = string.maketrans(filters,split*len(filters))
+        self.unicode_table = dict((ord(c),unicode(split)) for c in filters)
+
+    def words(self,text):
+        '''
+        keras text_to_word_sequence with the tokenizer's settings
+        '''
+        if not isinstance(text,basestring):
+            return []
+        if self.lower:
+            text = text.lower()
+        if isinstance(text,unicode):
+            text = text.translate(self.unicode_table)
+        else:
+            text = text.translate(self.str_table)
+        return [w for w in text.split(self.split) if w]
+
+    def transform(self,texts,mode="binary"):
+        '''
+        args:
+            texts: sequence of strings
+            mode: one of "binary", "count", "tfidf", "freq"
+        returns:
+            (len(texts), nb_words) float32 CSR matrix
+        '''
+        assert mode in self.MODES, "unknown mode %s" %mode
+        if mode=="tfidf":
+            assert self.idf is not None, "tfidf needs a tokenizer fit on texts"
+        get = self.word_index.get
+        cols = []
+        indptr = [0]
+        for text in texts:
+            cols.extend(i for i in [get(w) for w in self.words(text)] if i is not None)
+            indptr.append(len(cols))
+        cols = np.array(cols,dtype=np.int32)
+        rows = np.repeat(np.arange(len(indptr)-1,dtype=np.int32),np.diff(indptr))
+        counts = scipy.sparse.csr_matrix((np.ones(len(cols),dtype=np.float32),(rows,cols)),
+                                         shape=(len(indptr)-1,self.nb_words))
+        counts.sum_duplicates()
+        if mode=="binary":
+            counts.data[:] = 1
+        elif mode=="freq":
+            doc_len = np.diff(indptr).astype(np.float32)
+            counts.data /= np.repeat(doc_len,np.diff(counts.indptr))
+        elif mode=="tfidf":
+            counts.data = (1 + np.log(counts.data))*self.idf[counts.indices]
+        return counts
+
+class HashingVectorizer(Vectorizer):
+    '''
+    bag of words by the hashing trick: each word goes to bucket
+    crc32(word) % n_buckets, so there is no vocabulary to fit and any shard of
+    texts can be vectorised on its own, now or later.  Words are split as a
+    default keras Tokenizer does.  If signed, the top bit of the hash gives
+    each word a sign, so that colliding words tend to cancel rather than add up
+    '''
+    MODES = ("binary","count","freq")
+
+    def __init__(self,n_buckets=2**18,signed=True,filters=DEFAULT_FILTERS,lower=True,split=" "):
+        assert 0<n_buckets<=2**31
+        self.set_filters(filters,lower,split)
+        self.nb_words = n_buckets
+        self.signed = signed
+        #bucket and sign of each word seen, so repeated words are hashed once
+        self.memo = {}
+
+    def hash_word(self,word):
+        if isinstance(word,unicode):
+            word = word.encode('utf-8')
+        h = zlib.crc32(word) & 0xffffffff
+        sign = -1 if self.signed and h>>31 else 1
+        return h % self.nb_words, sign
+
+    def transform(self,texts,mode="binary"):
+        '''
+        args:
+            texts: sequence of strings
+            mode: one of "binary", "count", "freq".  Binary entries are the
+                sign of the summed bucket, counts are signed if signed
+        returns:
+            (len(texts), n_buckets) float32 CSR matrix
+        '''
+        assert mode in self.MODES, "unknown mode %s" %mode
+        memo = self.memo
+        cols = []
+        signs = []
+        indptr = [0]
+        for text in texts:
+            for w in self.words(text):
+                if w not in memo:
+                    memo[w] = self.hash_word(w)
+                col,sign = memo[w]
+                cols.append(col)
+                signs.append(sign)
+            indptr.append(len(cols))
+        rows = np.repeat(np.arange(len(indptr)-1,dtype=np.int32),np.diff(indptr))
+        counts = scipy.sparse.csr_matrix((np.array(signs,dtype=np.float32),(rows,np.array(cols,dtype=np.int32))),
+                                         shape=(len(indptr)-1,self.nb_words))
+        counts.sum_duplicates()
+        if mode=="binary":
+            counts.data = np.sign(counts.data)
+        elif mode=="freq":
+            doc_len = np.diff(indptr).astype(np.float32)
+            counts.data /= np.repeat(doc_len,np.diff(counts.indptr))
+        counts.eliminate_zeros()
+        return counts
+
+#only its words() is used, to split texts like a default keras Tokenizer
+_keras_splitter = HashingVectorizer()
+
+def keras_words(text):
+    return _keras_splitter.words(text)
+
+_worker_vectorizer = None
+
+def _init_worker(vectorizer):
+    global _worker_vectorizer
+    _worker_vectorizer = vectorizer
+
+def _transform_chunk(args):
+    texts,mode = args
+    return _worker_vectorizer.transform(texts,mode)
+
+def texts_to_csr(vectorizer,texts,mode="binary",num_processes=1,chunk_size=10000):
+    '''
+    vectorizer (a Vectorizer or HashingVectorizer).transform over chunks of chunk_size texts, across num_processes
+    worker processes if more than one, stacked back in order
+    returns:
+        (len(texts), nb_words) float32 CSR matrix
+    '''
+    texts = list(texts)
+    if num_processes<=1 or len(texts)<=chunk_size:
+        return vectorizer.transform(texts,mode)
+    chunks = [(texts[start:start+chunk_size],mode) for start in range(0,len(texts),chunk_size)]
+    pool = multiprocessing.Pool(num_processes,_init_worker,(vectorizer,))
+    try:
+        matrices = pool.map(_transform_chunk,chunks)
+    finally:
+        pool.close()
+        pool.join()
+    return scipy.sparse.vstack(matrices,format='csr')
+
+def series_to_bag_of_words(series,tokenizer,text_matrix_path,mode="binary",sparse=False,chunk_size=10000,num_processes=1):
     '''
     args:
         series: pandas series made up of strings
-        tokenizer: keras Tokenizer
+        tokenizer: keras Tokenizer, or a Vectorizer/HashingVectorizer to use as is
         mode:one of "binary", "count", "tfidf", "freq" (default: "binary")
+        sparse: if True, return a scipy CSR matrix, otherwise a dense float32 array
+        chunk_size, num_processes: documents per chunk and worker processes for texts_to_csr
     returns:
         text_matrix:bag of words matrix of shape (len(texts), nb_words)
     '''
     #TODO: check if text matrix path exists?
     texts = series
     idx = series.index
-    text_matrix = tokenizer.texts_to_matrix(texts,mode).astype(np.float32)
+    if isinstance(tokenizer,Vectorizer):
+        vectorizer = tokenizer
+    else:
+        vectorizer = Vectorizer(tokenizer)
+    text_matrix = texts_to_csr(vectorizer,texts,mode,num_processes,chunk_size)
+    if not sparse:
+        text_matrix = text_matrix.toarray()
     with open(text_matrix_path,'wb') as outf:
         pkl.dump(text_matrix,outf)
     #return pd.DataFrame(text_matrix, index=series.index)
-    assert text_matrix.shape==(len(idx),tokenizer.nb_words)
+    assert text_matrix.shape==(len(idx),vectorizer.nb_words)
     return text_matrix,idx
 
 def main():
@@ -57,8 +271,10 @@ def main():
     textpath = DATADIR + 'train_set.csv'
     nb_words = 5000
     tokpath = 'tokenizer_%i.pkl' %nb_words
-    train_df = pd.read_csv(textpath,header = 0, index_col = 0,low_memory = False)
-    build_tokenizer(train_df.description_clean,nb_words,tokpath)
+    counts_path = DATADIR + 'word_counts.npz'
+    train_df = table_store.read_csv_columns(textpath,['description_clean'])
+    tok,counts = build_tokenizer(train_df.description_clean,nb_words,tokpath,multiprocessing.cpu_count())
+    counts.save(counts_path)
 
     #TODO:
     # build text matrix from training, validation, test sets
@@ -0,0 +1,748 @@
+'''
+benchmarks.py
+
+Timing comparisons of the data pipeline steps, runnable without the cluster.
+usage: python benchmarks.py [benchmark] [args...]
+'''
+
+import os,sys
+import time
+import shutil
+import tempfile
+import threading
+import io
+
+import numpy as np
+import pandas as pd
+
+
+def make_test_jpeg(height=600,width=400,seed=0):
+    '''
+    smooth random rgb image encoded as jpeg bytes, roughly like a product photo
+    '''
+    from PIL import Image
+    rng = np.random.RandomState(seed)
+    small = rng.randint(0,256,(height/20,width/20,3)).astype(np.uint8)
+    im = Image.fromarray(small).resize((width,height),Image.BILINEAR)
+    buf = io.BytesIO()
+    im.save(buf,'JPEG',quality=90)
+    return buf.getvalue()
+
+def start_image_server(image_bytes,latency=0.05):
+    '''
+    serve image_bytes at every path on a local port, sleeping [latency] seconds
+    per request to stand in for the image CDN.
+    returns:
+        server, base_url
+    '''
+    import BaseHTTPServer
+    import SocketServer
+
+    class ImageHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        def do_GET(self):
+            time.sleep(latency)
+            self.send_response(200)
+            self.send_header('Content-Type','image/jpeg')
+            self.send_header('Content-Length',str(len(image_bytes)))
+            self.end_headers()
+            self.wfile.write(image_bytes)
+        def log_message(self,*args):
+            pass
+
+    class ThreadedServer(SocketServer.ThreadingMixIn,BaseHTTPServer.HTTPServer):
+        daemon_threads = True
+
+    server = ThreadedServer(('127.0.0.1',0),ImageHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server, 'http://127.0.0.1:%i/' %server.server_address[1]
+
+def bench_downloads(n_images=200,num_workers=16,latency=0.05,num_processes=None):
+    '''
+    serial prep_image loop vs. concurrent download_images against a local server
+    '''
+    import download_images_to_directory as dl
+
+    server,base_url = start_image_server(make_test_jpeg(),latency)
+    image_urls = pd.Series([base_url+'img_%i.jpg' %i for i in range(n_images)])
+    try:
+        for name in ['serial','concurrent']:
+            datadir = tempfile.mkdtemp() + '/'
+            os.makedirs(datadir+'images')
+            t0 = time.time()
+            if name=='serial':
+                for i,url in image_urls.iteritems():
+                    dl.prep_image(url,i,'bench',datadir)
+            else:
+                stats = dl.download_images(image_urls,'bench',datadir,
+                                           num_workers=num_workers,num_processes=num_processes)
+            elapsed = time.time()-t0
+            print "%-10s %i images in %.2fs (%.1f images/sec)" %(name,n_images,elapsed,n_images/elapsed)
+            if name=='concurrent':
+                dl.report_download_stats(stats,num_workers,num_processes)
+            shutil.rmtree(datadir)
+    finally:
+        server.shutdown()
+
+def check_store_writes(n_images=20,num_workers=4,num_processes=2):
+    '''
+    download_images into an image shard from a server of RGBA pngs, which the
+    skimage backend decodes with their alpha channel: every image must be
+    stored with 3 channels.  Then into a shard whose writes
+    fail: the download must finish, with every image counted as failed
+    '''
+    from PIL import Image
+    import image_store
+    import download_images_to_directory as dl
+
+    rgba = np.zeros((300,200,4),dtype=np.uint8)
+    rgba[:,:,3] = 128
+    buf = io.BytesIO()
+    Image.fromarray(rgba).save(buf,'PNG')
+    server,base_url = start_image_server(buf.getvalue(),latency=0.)
+    image_urls = pd.Series([base_url+'img_%i.png' %i for i in range(n_images)])
+    datadir = tempfile.mkdtemp() + '/'
+    try:
+        store = image_store.ImageShard.create(datadir + 'rgba/',image_urls.index.values,224)
+        stats = dl.download_images(image_urls,'check',datadir,num_workers=num_workers,
+                                   num_processes=num_processes,resize_backend='skimage',image_store=store)
+        assert stats['downloaded']==n_images and store.valid.all(), stats
+        print "%i RGBA images stored as RGB" %n_images
+
+        class FailingShard(object):
+            def __contains__(self,row_id):
+                return False
+            def write(self,row_id,rawim):
+                raise IOError("disk full")
+            def flush(self):
+                pass
+        stats = dl.download_images(image_urls,'check',datadir,num_workers=num_workers,
+                                   num_processes=num_processes,resize_backend='pil',image_store=FailingShard())
+        assert stats['failed']==n_images and stats['downloaded']==0, stats
+        print "failed writes were counted and the download finished"
+    finally:
+        server.shutdown()
+        shutil.rmtree(datadir)
+
+def check_retries(max_retries=3):
+    '''
+    fetch_with_retries against a local server: a 404 must fail after one
+    request, a 503 must be tried max_retries+1 times, and a 503 followed by a
+    200 must succeed on the second request
+    '''
+    import BaseHTTPServer
+    import SocketServer
+    import download_images_to_directory as dl
+
+    requests = {}
+    class StatusHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        def do_GET(self):
+            requests[self.path] = requests.get(self.path,0) + 1
+            status = int(self.path.split('/')[1])
+            if self.path.endswith('/flaky') and requests[self.path]>1:
+                status = 200
+            self.send_response(status)
+            self.send_header('Content-Length','2')
+            self.end_headers()
+            self.wfile.write('ok')
+        def log_message(self,*args):
+            pass
+
+    class ThreadedServer(SocketServer.ThreadingMixIn,BaseHTTPServer.HTTPServer):
+        daemon_threads = True
+
+    server = ThreadedServer(('127.0.0.1',0),StatusHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    base_url = 'http://127.0.0.1:%i' %server.server_address[1]
+    connections = {}
+    try:
+        limiter = dl.RateLimiter()
+        for path,expected_requests in [('/404/missing',1),('/503/down',max_retries+1)]:
+            try:
+                dl.fetch_with_retries(base_url+path,connections,limiter,max_retries,backoff=0.01)
+            except dl.HTTPError:
+                pass
+            else:
+                raise AssertionError("%s did not fail" %path)
+            assert requests[path]==expected_requests, "%s: %i requests" %(path,requests[path])
+        assert dl.fetch_with_retries(base_url+'/503/flaky',connections,limiter,max_retries,backoff=0.01)=='ok'
+        assert requests['/503/flaky']==2
+        print "404 failed after 1 request, 503 retried %i times, transient 503 recovered" %max_retries
+    finally:
+        for conn in connections.values():
+            conn.close()
+        server.shutdown()
+
+def check_resize_parity(width=224,max_mean_diff=4.,sizes=((600,400),(400,600),(1200,900),(500,500))):
+    '''
+    compare the 'pil' resize backend against the 'skimage' one on test jpegs.
+    raises AssertionError if the mean absolute pixel difference is above max_mean_diff
+    '''
+    import download_images_to_directory as dl
+    for i,(h,w) in enumerate(sizes):
+        data = make_test_jpeg(h,w,seed=i)
+        reference = dl.decode_and_resize(data,'x.jpg',width,'skimage').astype(np.float32)
+        fast = dl.decode_and_resize(data,'x.jpg',width,'pil').astype(np.float32)
+        assert fast.shape==reference.shape==(width,width,3)
+        diff = np.abs(fast-reference)
+        print "%4ix%-4i mean abs diff %.2f, max abs diff %i" %(h,w,diff.mean(),diff.max())
+        assert diff.mean()<=max_mean_diff
+
+def bench_resize(n_images=50,width=224,height=1200,image_width=900):
+    '''
+    per-image decode+resize latency of each resize backend, after a parity check
+    '''
+    import download_images_to_directory as dl
+    check_resize_parity(width)
+    data = make_test_jpeg(height,image_width)
+    for backend in dl.RESIZE_BACKENDS:
+        times = []
+        for i in range(n_images):
+            t0 = time.time()
+            dl.decode_and_resize(data,'x.jpg',width,backend)
+            times.append(time.time()-t0)
+        print "%-8s median %.2f ms/image, min %.2f ms/image" %(backend,1000*np.median(times),1000*np.min(times))
+
+def bench_vgg(n_batches=3,batch_size=64,width=224):
+    '''
+    images/sec of fc7 feature extraction: per-image prep_for_vgg + np.vstack +
+    get_output().eval() (the old path) vs. the preallocated buffer and
+    compiled function.  Run with THEANO_FLAGS=device=cpu to time the cpu.
+    Needs ../data/vgg_cnn_s.pkl
+    '''
+    import theano
+    import lasagne
+    from lasagne.utils import floatX
+    import image_processing as ip
+
+    rng = np.random.RandomState(0)
+    rawims = rng.randint(0,256,(batch_size,width,width,3)).astype(np.uint8)
+    valid = np.ones(batch_size,dtype=bool)
+    print "theano device: %s" %theano.config.device
+    extractor = ip.get_extractor().load()
+
+    t0 = time.time()
+    for b in range(n_batches):
+        for k in range(batch_size):
+            im = np.swapaxes(np.swapaxes(rawims[k], 1, 2), 0, 1)[::-1, :, :] - extractor.mean_image
+            im = floatX(im[np.newaxis])
+            images = im if k==0 else np.vstack((images,im))
+        old = np.array(lasagne.layers.get_output(extractor.net['fc7'], images, deterministic=True).eval())
+    elapsed = time.time()-t0
+    print "old path: %.1f images/sec" %(n_batches*batch_size/elapsed)
+
+    raw_buffer,input_buffer = ip.allocate_batch_buffers(batch_size,width)
+    t0 = time.time()
+    for b in range(n_batches):
+        new = extractor.feature_fn(ip.prep_batch_for_vgg(rawims,valid,input_buffer,extractor.mean_image))
+    elapsed = time.time()-t0
+    print "new path: %.1f images/sec" %(n_batches*batch_size/elapsed)
+    print "max abs difference in fc7: %g" %np.abs(old-new).max()
+
+def numpy_conv2d(x,W,b,stride=1):
+    '''
+    reference im2col cross-correlation with relu, no padding, as caffe computes it
+    args:
+        x: (n,c,h,w) input
+        W: (f,c,k,k) filters
+        b: (f,) biases
+    '''
+    n,c,h,w = x.shape
+    f,_,k,_ = W.shape
+    oh = (h-k)//stride + 1
+    ow = (w-k)//stride + 1
+    cols = np.empty((n,c,k,k,oh,ow),dtype=x.dtype)
+    for i in range(k):
+        for j in range(k):
+            cols[:,:,i,j] = x[:,:,i:i+stride*oh:stride,j:j+stride*ow:stride]
+    out = np.tensordot(W,cols,axes=([1,2,3],[1,2,3])).transpose(1,0,2,3)
+    return np.maximum(out + b[np.newaxis,:,np.newaxis,np.newaxis],0)
+
+def numpy_lrn(x,alpha=1e-4,k=2.,beta=0.75,n=5):
+    '''
+    cross-channel local response normalisation as lasagne computes it
+    '''
+    half = n//2
+    sqr = np.zeros((x.shape[0],x.shape[1]+2*half) + x.shape[2:],dtype=x.dtype)
+    sqr[:,half:half+x.shape[1]] = x**2
+    scale = k + alpha*sum(sqr[:,i:i+x.shape[1]] for i in range(n))
+    return x / scale**beta
+
+def numpy_max_pool(x,size):
+    '''
+    max pool with stride == size and ignore_border=False: partial windows
+    at the bottom and right edges are pooled over what they cover
+    '''
+    n,c,h,w = x.shape
+    oh = -(-h//size)
+    ow = -(-w//size)
+    padded = np.full((n,c,oh*size,ow*size),-np.inf,dtype=x.dtype)
+    padded[:,:,:h,:w] = x
+    return padded.reshape(n,c,oh,size,ow,size).max(axis=(3,5))
+
+def numpy_vgg_fc7(images,values):
+    '''
+    reference float64 forward pass of image_processing.build_image_network
+    up to fc7, with dropout off, from the model's parameter values
+    args:
+        images: (n, 3, 224, 224) input as prep_batch_for_vgg gives it
+        values: model['values'] of vgg_cnn_s.pkl
+    '''
+    W = [np.asarray(v,dtype=np.float64) for v in values]
+    pad = lambda x: np.pad(x,((0,0),(0,0),(1,1),(1,1)),'constant')
+    x = np.asarray(images,dtype=np.float64)
+    x = numpy_max_pool(numpy_lrn(numpy_conv2d(x,W[0],W[1],stride=2)),3)
+    x = numpy_max_pool(numpy_conv2d(x,W[2],W[3]),2)
+    x = numpy_conv2d(pad(x),W[4],W[5])
+    x = numpy_conv2d(pad(x),W[6],W[7])
+    x = numpy_max_pool(numpy_conv2d(pad(x),W[8],W[9]),3)
+    x = np.maximum(x.reshape(x.shape[0],-1).dot(W[10]) + W[11],0)
+    return np.maximum(x.dot(W[12]) + W[13],0)
+
+def bench_vgg_backends(num_threads=1,n_batches=3,batch_size=32,width=224):
+    '''
+    fc7 images/sec of the 'cpu' conv backend with [num_threads] openmp threads.
+    First checks the cpu network's fc7 against numpy_vgg_fc7 on a few images,
+    and against the 'dnn' network when cuDNN is available.  The max abs
+    difference must be within 1e-4 of the largest fc7 activation (at least 1).
+    The thread count only applies if theano has not been imported yet.
+    Needs ../data/vgg_cnn_s.pkl
+    '''
+    os.environ['OMP_NUM_THREADS'] = str(num_threads)
+    os.environ['THEANO_FLAGS'] = ','.join(f for f in ['openmp=True',os.environ.get('THEANO_FLAGS')] if f)
+    import theano
+    import image_processing as ip
+
+    rng = np.random.RandomState(0)
+    rawims = rng.randint(0,256,(batch_size,width,width,3)).astype(np.uint8)
+    valid = np.ones(batch_size,dtype=bool)
+    cpu = ip.VGGFeatureExtractor(backend='cpu').load()
+    cpu_fn = cpu.feature_fn
+    raw_buffer,input_buffer = ip.allocate_batch_buffers(batch_size,width)
+    images = ip.prep_batch_for_vgg(rawims,valid,input_buffer,cpu.mean_image)
+
+    references = [('numpy',numpy_vgg_fc7(images[:2],cpu.model['values']),2)]
+    if ip.default_conv_backend()=='dnn':
+        dnn_fn = ip.VGGFeatureExtractor(backend='dnn').load().feature_fn
+        references.append(('dnn',dnn_fn(images),batch_size))
+    features = cpu_fn(images)
+    for name,reference,n in references:
+        diff = np.abs(features[:n]-reference)
+        print "fc7 cpu vs %s: max abs diff %g (max activation %g)" %(name,diff.max(),reference.max())
+        assert diff.max()<=1e-4*max(1.,reference.max()), "cpu fc7 differs from %s" %name
+
+    t0 = time.time()
+    for b in range(n_batches):
+        cpu_fn(images)
+    elapsed = time.time()-t0
+    print "cpu backend, %i threads: %.1f images/sec" %(num_threads,n_batches*batch_size/elapsed)
+
+def bench_imports(modules=('utils','image_store','table_store','download_images_to_directory','bag_of_words',
+                           'data_prep','image_processing','stitch_image_feature_files','models')):
+    '''
+    wall time and peak memory of importing each script module in a fresh interpreter
+    '''
+    import subprocess
+    here = os.path.dirname(os.path.abspath(__file__))
+    code = ("import time,resource; t0=time.time(); import %s; "
+            "print time.time()-t0, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss")
+    for module in modules:
+        proc = subprocess.Popen([sys.executable,'-c',code %module],cwd=here,
+                                stdout=subprocess.PIPE,stderr=subprocess.PIPE)
+        out,err = proc.communicate()
+        if proc.returncode!=0:
+            print "%-30s import failed: %s" %(module,err.strip().split('\n')[-1])
+            continue
+        seconds,maxrss = out.strip().split('\n')[-1].split()
+        print "%-30s %6.2fs %7.1f MB" %(module,float(seconds),int(maxrss)/1024.)
+
+def merge_high_water_mark(method,n_rows,n_brands,n_words,n_image):
+    '''
+    peak memory added by merging one split of synthetic brand (float64 one-hot),
+    bag of words (float64) and image (float32) blocks, printed as MB.
+    method 'hstack' is the old successive np.hstack + astype; 'assemble' is
+    data_prep.assemble_features; 'sparse' is assemble_features with the brand
+    and bag of words blocks as CSR, as main builds them with sparse=True.
+    Run in a fresh interpreter by bench_merge.
+    '''
+    import resource
+    import scipy.sparse
+    import data_prep
+    rng = np.random.RandomState(0)
+    brand = np.zeros((n_rows,n_brands))
+    brand[np.arange(n_rows),rng.randint(0,n_brands,n_rows)] = 1
+    bow = np.zeros((n_rows,n_words))
+    image = np.empty((n_rows,n_image),dtype=np.float32)
+    #filled in chunks so generating the inputs does not set the high-water mark
+    for i in range(0,n_rows,1000):
+        bow[i:i+1000] = rng.rand(min(1000,n_rows-i),n_words)<0.01
+        image[i:i+1000] = rng.rand(min(1000,n_rows-i),n_image)
+    if method=='sparse':
+        brand = scipy.sparse.csr_matrix(brand)
+        bow = scipy.sparse.csr_matrix(bow)
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if method=='hstack':
+        X = np.hstack((brand,bow))
+        X = np.hstack((X,image))
+        X = X.astype(np.float32)
+    else:
+        X = data_prep.assemble_features([brand,bow,image])
+    after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    assert isinstance(X,np.ndarray) and X.dtype==np.float32 and X.shape==(n_rows,n_brands+n_words+n_image)
+    print (after-before)/1024., X.nbytes/1024.**2, float(np.abs(X[:,-n_image:]-image).max())
+
+def bench_merge(n_rows=20000,n_brands=500,n_words=2000,n_image=4096):
+    '''
+    memory high-water mark of merge_data's old hstack chain vs. assemble_features
+    for one split, from dense and from sparse brand and bag of words blocks.
+    Fails if assembling needs more than the output plus 10%.
+    '''
+    import subprocess
+    here = os.path.dirname(os.path.abspath(__file__))
+    code = "import benchmarks; benchmarks.merge_high_water_mark('%s',%i,%i,%i,%i)"
+    for method in ['hstack','assemble','sparse']:
+        proc = subprocess.Popen([sys.executable,'-c',code %(method,n_rows,n_brands,n_words,n_image)],
+                                cwd=here,stdout=subprocess.PIPE)
+        out,err = proc.communicate()
+        assert proc.returncode==0, "%s run failed" %method
+        peak,output_mb,diff = [float(x) for x in out.strip().split('\n')[-1].split()]
+        print "%-8s peak +%7.1f MB for a %.1f MB output (%.1fx), image max abs diff %g" \
+            %(method,peak,output_mb,peak/output_mb,diff)
+        if method!='hstack':
+            assert peak<=1.1*output_mb and diff==0
+
+def check_assemble(n_rows=1000,n_brands=50,n_words=300,n_image=64):
+    '''
+    output type and size of data_prep.assemble_features: CSR when every block
+    is sparse, a dense float32 array when the dense image block is included,
+    with the same values either way
+    '''
+    import scipy.sparse
+    import data_prep
+    rng = np.random.RandomState(0)
+    brand = scipy.sparse.csr_matrix((np.ones(n_rows),(np.arange(n_rows),rng.randint(0,n_brands,n_rows))),
+                                    shape=(n_rows,n_brands))
+    bow = scipy.sparse.csr_matrix(rng.rand(n_rows,n_words)<0.02,dtype=np.float64)
+    image = rng.rand(n_rows,n_image).astype(np.float32)
+
+    X = data_prep.assemble_features([brand,bow])
+    assert scipy.sparse.isspmatrix_csr(X) and X.dtype==np.float32 and X.shape==(n_rows,n_brands+n_words)
+    print "text only: CSR %s, %i nonzeros" %(X.shape,X.nnz)
+
+    X_dense = np.hstack([brand.toarray(),bow.toarray(),image]).astype(np.float32)
+    for blocks in [[brand,bow,image],[brand.toarray(),bow.toarray(),image]]:
+        X = data_prep.assemble_features(blocks)
+        assert isinstance(X,np.ndarray) and X.dtype==np.float32 and X.shape==X_dense.shape
+        assert X.nbytes==n_rows*(n_brands+n_words+n_image)*4
+        assert np.array_equal(X,X_dense)
+    print "with images: dense %s, %.1f MB" %(X.shape,X.nbytes/1024.**2)
+
+def make_catalogue_csv(path,n_rows,seed=0):
+    '''
+    write a csv shaped like train_set.csv: text, brand, category names and
+    numbers and image urls, with some missing values
+    '''
+    rng = np.random.RandomState(seed)
+    words = np.array(['soft','cotton','black','dress','leather','boot','slim','fit','wool','navy',
+                      'silk','blend','ankle','strap','classic','crew','neck','tee','stretch','denim'])
+    descriptions = [' '.join(rng.choice(words,rng.randint(5,40))) for i in range(n_rows)]
+    df = pd.DataFrame({
+        'description_clean': descriptions,
+        'brand': rng.choice(['brand_%i' %i for i in range(2000)],n_rows),
+        'cat_1': rng.choice(['cat1_%i' %i for i in range(10)],n_rows),
+        'cat_2': rng.choice(['cat2_%i' %i for i in range(60)],n_rows),
+        'cat_1_num': rng.randint(0,10,n_rows),
+        'cat_2_num': rng.randint(0,60,n_rows),
+        'cat_3_num': rng.randint(0,400,n_rows),
+        'price': rng.rand(n_rows)*200,
+        'large_image_URL': ['http://images.example.com/%i.jpeg' %i for i in range(n_rows)],
+    },index=rng.permutation(n_rows)*3)
+    df.loc[df.index[::50],'description_clean'] = np.nan
+    df.to_csv(path)
+
+def check_chunked_empty_split(n_rows=500,chunk_rows=100):
+    '''
+    data_prep.main_chunked on a catalogue with no validation rows and an empty
+    test csv: the empty splits must open as (0, width) views with no targets
+    '''
+    import data_prep
+    tmpdir = tempfile.mkdtemp() + '/'
+    try:
+        make_catalogue_csv(tmpdir + 'train_set.csv',n_rows)
+        make_catalogue_csv(tmpdir + 'test_set.csv',0)
+        for attempt in ['prepared','reopened']:
+            data,n_values = data_prep.main_chunked(tmpdir,val_portion=0.,use_images=False,use_text=False,
+                                                   chunk_rows=chunk_rows)
+            (X_train,y1_train,y2_train,y3_train),val,test = data
+            assert X_train.shape[0]==n_rows and len(y1_train)==n_rows
+            for name,(X,y1,y2,y3) in [('val',val),('test',test)]:
+                assert X.shape==(0,X_train.shape[1]), "%s X is %s" %(name,X.shape)
+                assert len(y1)==len(y2)==len(y3)==0
+                assert X[0:10].shape==(0,X_train.shape[1]) and y1[0:10].shape==(0,)
+            print "%s: train %s, val %s, test %s" %(attempt,X_train.shape,val[0].shape,test[0].shape)
+    finally:
+        shutil.rmtree(tmpdir)
+
+def check_missing_images(n_rows=400,n_image=16,chunk_rows=100):
+    '''
+    rows without image features are dropped, not zero-filled: with features
+    stored for every other row, data_prep.drop_rows_without_images and
+    main_chunked must keep exactly the rows that have them
+    '''
+    import feature_store
+    import data_prep
+    tmpdir = tempfile.mkdtemp() + '/'
+    try:
+        make_catalogue_csv(tmpdir + 'train_set.csv',n_rows)
+        make_catalogue_csv(tmpdir + 'test_set.csv',n_rows//4,seed=1)
+        for split in ['train','test']:
+            df = pd.read_csv(tmpdir + split + '_set.csv',header = 0, index_col = 0)
+            ids = np.sort(df.index.values)[::2]
+            sink = feature_store.FeatureSink(tmpdir + split + '_images/')
+            sink.append(ids,np.ones((len(ids),n_image),dtype=np.float32),0,len(ids))
+
+        trainDF = pd.read_csv(tmpdir + 'train_set.csv',header = 0, index_col = 0)
+        testDF = pd.read_csv(tmpdir + 'test_set.csv',header = 0, index_col = 0)
+        trainDF,valDF = data_prep.train_val_split(trainDF,0.2)
+        kept = data_prep.drop_rows_without_images(tmpdir + 'train_images',tmpdir + 'test_images',trainDF,valDF,testDF)
+        stores = ['train_images/','train_images/','test_images/']
+        for df,original,store in zip(kept,[trainDF,valDF,testDF],stores):
+            found = feature_store.FeatureSink(tmpdir + store).has_rows(original.index.values)
+            assert df.index.equals(original.index[found])
+        print "kept %s of %s rows with image features" %([df.shape[0] for df in kept],
+                                                          [trainDF.shape[0],valDF.shape[0],testDF.shape[0]])
+
+        data,n_values = data_prep.main_chunked(tmpdir,val_portion=0.2,use_images=True,use_text=False,
+                                               train_image_fn='train_images',test_image_fn='test_images',
+                                               chunk_rows=chunk_rows)
+        for (X,y1,y2,y3),n in zip(data,[kept[0].shape[0],kept[1].shape[0],kept[2].shape[0]]):
+            assert X.shape[0]==n==len(y1), "%i rows, expected %i" %(X.shape[0],n)
+            assert (X[:][:,-n_image:]==1).all()
+        print "main_chunked stored only rows with image features"
+    finally:
+        shutil.rmtree(tmpdir)
+
+def bench_load(n_rows=200000,columns=('description_clean','brand','cat_1_num','cat_2_num','cat_3_num')):
+    '''
+    pd.read_csv of a synthetic catalogue csv vs. table_store.read_csv_columns
+    of the columns data_prep uses, after a one-off conversion.  Checks the
+    loaded columns match the csv
+    '''
+    import table_store
+    tmpdir = tempfile.mkdtemp() + '/'
+    try:
+        csv_path = tmpdir + 'train_set.csv'
+        make_catalogue_csv(csv_path,n_rows)
+        columns = list(columns)
+
+        t0 = time.time()
+        reference = pd.read_csv(csv_path,header = 0, index_col = 0,low_memory = False)
+        print "read_csv, all columns:      %.2fs" %(time.time()-t0)
+        t0 = time.time()
+        table_store.convert_csv(csv_path)
+        print "one-off conversion:         %.2fs" %(time.time()-t0)
+        t0 = time.time()
+        df = table_store.read_csv_columns(csv_path,columns)
+        print "column store, %i columns:    %.2fs" %(len(columns),time.time()-t0)
+        t0 = time.time()
+        table_store.read_csv_columns(csv_path,columns,as_categorical=True)
+        print "  as categoricals:          %.2fs" %(time.time()-t0)
+
+        assert df.index.equals(reference.index) and list(df.columns)==columns
+        for name in columns:
+            assert df[name].dtype==reference[name].dtype, name
+            assert df[name].equals(reference[name]), name
+        assert table_store.read_csv_columns(csv_path).equals(reference)
+        print "loaded columns match read_csv"
+    finally:
+        shutil.rmtree(tmpdir)
+
+def bench_bow(n_docs=50000,nb_words=5000,num_processes=4):
+    '''
+    docs/sec of the keras Tokenizer.texts_to_matrix path vs. bag_of_words
+    texts_to_csr, serial and over num_processes workers, and the hashing
+    vectoriser.  Checks the binary, count and freq modes match texts_to_matrix
+    on the first 2000 documents (tfidf changed formula between keras versions)
+    '''
+    import scipy.sparse
+    import bag_of_words
+    rng = np.random.RandomState(0)
+    vocab = np.array(['word%i' %i for i in range(3*nb_words)])
+    #zipf-ish word frequencies so nb_words cuts off a long tail
+    p = 1./np.arange(1,len(vocab)+1)
+    p /= p.sum()
+    texts = [' '.join(rng.choice(vocab,rng.randint(5,60),p=p)) + ', fit.' for i in range(n_docs)]
+    tokenizer = bag_of_words.Tokenizer(nb_words=nb_words)
+    tokenizer.fit_on_texts(texts)
+    vectorizer = bag_of_words.Vectorizer(tokenizer)
+
+    for mode in ["binary","count","freq"]:
+        expected = tokenizer.texts_to_matrix(texts[:2000],mode)
+        got = vectorizer.transform(texts[:2000],mode)
+        assert scipy.sparse.isspmatrix_csr(got)
+        assert np.allclose(got.toarray(),expected,rtol=1e-5,atol=1e-6), mode
+    print "binary, count and freq match texts_to_matrix"
+
+    t0 = time.time()
+    for start in range(0,n_docs,10000):
+        tokenizer.texts_to_matrix(texts[start:start+10000],"binary")
+    print "keras texts_to_matrix:     %8.0f docs/sec" %(n_docs/(time.time()-t0))
+    t0 = time.time()
+    bag_of_words.texts_to_csr(vectorizer,texts,"binary")
+    print "texts_to_csr, 1 process:   %8.0f docs/sec" %(n_docs/(time.time()-t0))
+    t0 = time.time()
+    bag_of_words.texts_to_csr(vectorizer,texts,"binary",num_processes)
+    print "texts_to_csr, %i processes: %8.0f docs/sec" %(num_processes,n_docs/(time.time()-t0))
+    hashing = bag_of_words.HashingVectorizer(2**18)
+    t0 = time.time()
+    bag_of_words.texts_to_csr(hashing,texts,"binary")
+    print "hashing, 1 process:        %8.0f docs/sec" %(n_docs/(time.time()-t0))
+
+#fixture corpus for check_moses: (sentence, tokenizer.perl -l en -q output)
+MOSES_FIXTURES = [
+    ("Soft, stretchy cotton-blend tee.", "Soft , stretchy cotton-blend tee ."),
+    ("Women's 3/4-sleeve top (imported)", "Women &apos;s 3 / 4-sleeve top ( imported )"),
+    ("Price: $1,200.00 & up", "Price : $ 1,200.00 &amp; up"),
+    ("Wait... really?", "Wait ... really ?"),
+    ('Don\'t "quote" [it] <b>|', "Don &apos;t &quot; quote &quot; &#91; it &#93; &lt; b &gt; &#124;"),
+    ("Made in the U.S. Dr. Martens boots.", "Made in the U.S. Dr. Martens boots ."),
+    ("Sizes 1990's and ''classic'' `fit`", "Sizes 1990 &apos;s and &apos; &apos; classic &apos; &apos; `fit`"),
+    ("Item No. 5 ships.", "Item No. 5 ships ."),
+    ("e.g. wool", "e.g. wool"),
+    ("50% off_sale!", "50 % off _ sale !"),
+    ("A,B,C,D", "A , B , C , D"),
+    ("He said 'hi.'", "He said &apos; hi . &apos;"),
+    ("Size 5,", "Size 5 ,"),
+    ("It's a 'must-have'!", "It &apos;s a &apos; must-have &apos; !"),
+    ("Mr. Smith vs. Mrs. Jones pp. 5 and No. 7", "Mr. Smith vs. Mrs. Jones pp. 5 and No. 7"),
+    ("Caf\xc3\xa9 cr\xc3\xa8me.", "Caf\xc3\xa9 cr\xc3\xa8me ."),
+    ("   ", "   "),
+    ("'Tis fit", "&apos; Tis fit"),
+    ("a 'classic'", "a &apos; classic &apos;"),
+    ("'Quoted' start", "&apos; Quoted &apos; start"),
+    ("ends with quote'", "ends with quote &apos;"),
+    ("'90s style", "&apos; 90s style"),
+    ("Rock 'n' roll", "Rock &apos; n &apos; roll"),
+    ("it's 'ok'.", "it &apos;s &apos; ok &apos; ."),
+]
+
+def check_moses(n_sentences=2000,perl_path='./mosesdecoder/scripts/tokenizer/tokenizer.perl'):
+    '''
+    conformance of moses_tokenizer with tokenizer.perl: the fixture corpus
+    must give its expected output, and if perl_path exists, the fixtures and
+    n_sentences synthetic descriptions must give what tokenizer.perl gives.
+    Also checks that embedded newlines keep one output row per sentence, and
+    that tokenize_corpus over parallel tokenizer.perl workers and its cache
+    give the same rows as one tokenizer.perl run
+    '''
+    import subprocess
+    import moses_tokenizer
+    for sentence,expected in MOSES_FIXTURES:
+        got = moses_tokenizer.tokenize(sentence)
+        assert got==expected, "%r: got %r, expected %r" %(sentence,got,expected)
+    print "%i fixtures match" %len(MOSES_FIXTURES)
+
+    sentences = ["first line\nsecond line.","plain"," \n ","\n","","\r\n","a\rb"]
+    expected = ["first line second line .","plain","   "," ","","  ","a b"]
+    assert moses_tokenizer.tokenize_sentences(sentences)==expected
+    cache_dir = tempfile.mkdtemp()
+    try:
+        for attempt in ['tokenized','cached']:
+            got = moses_tokenizer.tokenize_corpus(sentences,chunk_size=2,cache_dir=cache_dir)
+            assert got==expected, "%s: %r" %(attempt,got)
+        chunks = [sentences[i:i+2] for i in range(0,len(sentences),2)]
+        for chunk in chunks:
+            path = os.path.join(cache_dir,moses_tokenizer.chunk_key('python %i' %moses_tokenizer.RULES_VERSION,chunk) + '.txt')
+            assert moses_tokenizer.read_cached(path,len(chunk)) is not None, "chunk %r not reused from the cache" %chunk
+    finally:
+        shutil.rmtree(cache_dir)
+    print "embedded newlines and blank sentences keep row alignment, and their chunks are cached"
+
+    #the perl cache key must change when the script or its prefix file is edited
+    moses_dir = tempfile.mkdtemp()
+    try:
+        script = os.path.join(moses_dir,'scripts','tokenizer','tokenizer.perl')
+        prefixes = os.path.join(moses_dir,'scripts','share','nonbreaking_prefixes','nonbreaking_prefix.en')
+        for path in [script,prefixes]:
+            os.makedirs(os.path.dirname(path))
+            with open(path,'w') as f:
+                f.write('v1\n')
+        perl_cmd = [script,'-l','en','-q','-']
+        keys = [moses_tokenizer.perl_backend(perl_cmd)]
+        assert moses_tokenizer.perl_backend(list(perl_cmd))==keys[0], "tokenizer.perl cache key is not stable"
+        for path in [script,prefixes]:
+            with open(path,'a') as f:
+                f.write('v2\n')
+            keys.append(moses_tokenizer.perl_backend(perl_cmd))
+        assert len(set(keys))==3, "editing tokenizer.perl or its prefix file kept the cache key"
+    finally:
+        shutil.rmtree(moses_dir)
+    print "the tokenizer.perl cache key follows the script and prefix file contents"
+
+    if not os.path.exists(perl_path):
+        print "%s not found, skipping the comparison with tokenizer.perl" %perl_path
+        return
+    tmpdir = tempfile.mkdtemp() + '/'
+    try:
+        make_catalogue_csv(tmpdir + 'catalogue.csv',n_sentences)
+        df = pd.read_csv(tmpdir + 'catalogue.csv',header = 0, index_col = 0)
+    finally:
+        shutil.rmtree(tmpdir)
+    sentences = [s for s,e in MOSES_FIXTURES if s.strip()] + \
+        list(df.description_clean.astype(str) + " " + df.brand.astype(str) + ". Fits true, e.g. 5'10\".")
+    proc = subprocess.Popen([perl_path,'-l','en','-q','-'],stdin=subprocess.PIPE,stdout=subprocess.PIPE)
+    out,err = proc.communicate('\n'.join(sentences) + '\n')
+    expected = out.split('\n')[:-1]
+    assert len(expected)==len(sentences)
+    t0 = time.time()
+    got = moses_tokenizer.tokenize_sentences(sentences)
+    print "moses_tokenizer: %.0f sentences/sec" %(len(sentences)/(time.time()-t0))
+    mismatches = [(s,g,e) for s,g,e in zip(sentences,got,expected) if g!=e]
+    for s,g,e in mismatches[:10]:
+        print "%r\n  got      %r\n  expected %r" %(s,g,e)
+    assert not mismatches, "%i of %i sentences differ from tokenizer.perl" %(len(mismatches),len(sentences))
+    print "%i sentences match tokenizer.perl" %len(sentences)
+
+    #sharded tokenizer.perl workers must give the single process output, row for row
+    cache_dir = tempfile.mkdtemp()
+    try:
+        perl_cmd = [perl_path,'-l','en','-q','-']
+        chunk_size = max(1,len(sentences)//8)
+        t0 = time.time()
+        got = moses_tokenizer.tokenize_corpus(sentences,perl_cmd,4,chunk_size,cache_dir)
+        t1 = time.time()
+        cached = moses_tokenizer.tokenize_corpus(sentences,perl_cmd,4,chunk_size,cache_dir)
+        t2 = time.time()
+    finally:
+        shutil.rmtree(cache_dir)
+    assert got==expected and cached==expected
+    print "4 tokenizer.perl workers: %.2fs, cached rerun: %.2fs" %(t1-t0,t2-t1)
+
+BENCHMARKS = {
+    'downloads': bench_downloads,
+    'retries': check_retries,
+    'store_writes': check_store_writes,
+    'resize': bench_resize,
+    'vgg': bench_vgg,
+    'vgg_backends': bench_vgg_backends,
+    'imports': bench_imports,
+    'merge': bench_merge,
+    'assemble': check_assemble,
+    'load': bench_load,
+    'chunked_empty': check_chunked_empty_split,
+    'missing_images': check_missing_images,
+    'bow': bench_bow,
+    'moses': check_moses,
+}
+
+if __name__ == '__main__':
+    if len(sys.argv)<2 or sys.argv[1] not in BENCHMARKS:
+        print "usage: python benchmarks.py [%s] [args...]" %'|'.join(sorted(BENCHMARKS))
+    else:
+        args = [float(a) if '.' in a else int(a) for a in sys.argv[2:]]
+        BENCHMARKS[sys.argv[1]](*args)
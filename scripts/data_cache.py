@@ -0,0 +1,186 @@
+'''
+data_cache.py
+
+Content-addressed cache for the prepared model data from data_prep.main.
+An entry is keyed by a sha1 of the prep parameters and of the contents of
+every input file, so a changed csv, tokenizer or image feature file gets a new
+entry instead of silently reusing stale data.  Each entry is a directory
+    [split]_[X|y1|y2|y3].npy: one array per file, memory-mapped on load
+    [split]_X_data.npy, _indices.npy, _indptr.npy, _shape.npy: a CSR X
+    n_values.pkl
+    complete: written last.  Its mtime is the last use, for LRU eviction
+'''
+
+import os
+import shutil
+import hashlib
+import json
+import cPickle as pkl
+import numpy as np
+import scipy.sparse
+from utils import plog
+
+SPLITS = ('train','val','test')
+ARRAY_NAMES = ('X','y1','y2','y3')
+
+def hash_file(path,chunk_size=1<<20):
+    h = hashlib.sha1()
+    with open(path,'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size),''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def save_array(entry,name,arr):
+    '''
+    save arr as entry/name.npy, or as its CSR parts if it is sparse
+    '''
+    if scipy.sparse.issparse(arr):
+        arr = arr.tocsr()
+        for part in ['data','indices','indptr']:
+            np.save(entry + '%s_%s.npy' %(name,part),getattr(arr,part))
+        np.save(entry + '%s_shape.npy' %name,np.array(arr.shape))
+    else:
+        np.save(entry + name + '.npy',np.asarray(arr))
+
+def load_array(entry,name):
+    '''
+    memory-mapped array saved by save_array.  A CSR matrix is rebuilt around
+    its memory-mapped parts
+    '''
+    if os.path.exists(entry + name + '.npy'):
+        return np.load(entry + name + '.npy',mmap_mode='r')
+    parts = [np.load(entry + '%s_%s.npy' %(name,part),mmap_mode='r') for part in ['data','indices','indptr']]
+    shape = tuple(np.load(entry + '%s_shape.npy' %name))
+    return scipy.sparse.csr_matrix(tuple(parts),shape=shape,copy=False)
+
+def entry_size(entry):
+    return sum(os.path.getsize(os.path.join(entry,fn)) for fn in os.listdir(entry))
+
+class ModelDataCache(object):
+    '''
+    cache of (data, n_values) tuples as returned by data_prep.main
+    '''
+    def __init__(self,cache_dir,max_bytes=20*1024**3):
+        '''
+        args:
+            cache_dir: directory of the entries, created if missing
+            max_bytes: total size above which least recently used entries are evicted
+        '''
+        if not cache_dir.endswith('/'):
+            cache_dir += '/'
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.fingerprint_path = cache_dir + 'fingerprints.json'
+        self.fingerprints = {}
+        if os.path.exists(self.fingerprint_path):
+            with open(self.fingerprint_path) as f:
+                self.fingerprints = json.load(f)
+
+    def fingerprint(self,path):
+        '''
+        sha1 of a file's contents, or of a directory's files and their names.
+        Digests are remembered by (size, mtime), so an unchanged file is only
+        read the first time.  Missing paths hash to 'missing'
+        '''
+        path = os.path.abspath(path)
+        if os.path.isdir(path):
+            h = hashlib.sha1()
+            for fn in sorted(os.listdir(path)):
+                h.update(fn)
+                h.update(self.fingerprint(os.path.join(path,fn)))
+            return h.hexdigest()
+        if not os.path.exists(path):
+            return 'missing'
+        st = os.stat(path)
+        memo = self.fingerprints.get(path)
+        if memo is not None and memo[0]==st.st_size and memo[1]==st.st_mtime:
+            return memo[2]
+        plog("Hashing %s..." %path)
+        digest = hash_file(path)
+        self.fingerprints[path] = [st.st_size,st.st_mtime,digest]
+        with open(self.fingerprint_path + '.tmp','w') as f:
+            json.dump(self.fingerprints,f)
+        os.rename(self.fingerprint_path + '.tmp',self.fingerprint_path)
+        return digest
+
+    def key(self,params,inputs):
+        '''
+        args:
+            params: dict of the prep parameters, json serialisable
+            inputs: dict of role (e.g. 'train_csv') to input path
+        returns:
+            hex sha1 of the parameters and input contents
+        '''
+        h = hashlib.sha1()
+        h.update(json.dumps(params,sort_keys=True))
+        for role in sorted(inputs):
+            h.update(role)
+            h.update(self.fingerprint(inputs[role]))
+        return h.hexdigest()
+
+    def get(self,key):
+        '''
+        returns:
+            (data, n_values) with memory-mapped arrays, or None on a miss
+        '''
+        entry = self.cache_dir + key + '/'
+        if not os.path.exists(entry + 'complete'):
+            plog("Model data cache miss: %s" %key)
+            return None
+        data = tuple(tuple(load_array(entry,split + '_' + name) for name in ARRAY_NAMES) for split in SPLITS)
+        with open(entry + 'n_values.pkl','rb') as f:
+            n_values = pkl.load(f)
+        os.utime(entry + 'complete',None)
+        plog("Model data cache hit: %s (%.1f MB)" %(key,entry_size(entry)/1024.**2))
+        return data,n_values
+
+    def put(self,key,data,n_values):
+        '''
+        write an entry, then evict old ones if the cache is over max_bytes.
+        The entry is built under a temporary name and renamed into place
+        '''
+        entry = self.cache_dir + key
+        tmp = entry + '.tmp%i/' %os.getpid()
+        os.makedirs(tmp)
+        for split,arrays in zip(SPLITS,data):
+            for name,arr in zip(ARRAY_NAMES,arrays):
+                save_array(tmp,split + '_' + name,arr)
+        with open(tmp + 'n_values.pkl','wb') as f:
+            pkl.dump(n_values,f)
+        open(tmp + 'complete','w').close()
+        if os.path.exists(entry):
+            #another job wrote the same entry first
+            shutil.rmtree(tmp)
+        else:
+            os.rename(tmp[:-1],entry)
+        plog("Model data cached: %s (%.1f MB)" %(key,entry_size(entry)/1024.**2))
+        self.evict(keep=key)
+
+    def entries(self):
+        '''
+        list of (last use, size in bytes, key) of the complete entries
+        '''
+        entries = []
+        for key in os.listdir(self.cache_dir):
+            entry = self.cache_dir + key + '/'
+            if os.path.exists(entry + 'complete'):
+                entries.append((os.path.getmtime(entry + 'complete'),entry_size(entry),key))
+        return entries
+
+    def evict(self,keep=None):
+        '''
+        remove least recently used entries, other than keep, until the cache
+        is at most max_bytes
+        '''
+        entries = sorted(self.entries())
+        total = sum(size for last_use,size,key in entries)
+        for last_use,size,key in entries:
+            if total<=self.max_bytes:
+                break
+            if key==keep:
+                continue
+            plog("Evicting model data cache entry %s (%.1f MB)" %(key,size/1024.**2))
+            shutil.rmtree(self.cache_dir + key)
+            total -= size
@@ -12,35 +12,41 @@ create_log(__file__)
 plog('importing modules...')
 from datetime import datetime
 import os
+import sys
+import shutil
+import multiprocessing
 import pandas as pd
 import numpy as np
+import scipy.sparse
 import pdb
 import cPickle as pkl
 import bag_of_words
+import feature_store
+import data_cache
+import table_store
+import splits
 from sklearn.preprocessing import OneHotEncoder
 
+#csv columns used to build the model data
+MODEL_COLUMNS = ['brand','description_clean','cat_1_num','cat_2_num','cat_3_num']
+
+#bump when a change to the prep code should invalidate cached model data
+CACHE_VERSION = 3
+
 
 def shuffle_and_downsample(df,samples):
     '''
-    shuffle dataframe, including previous indexes, then downsample
+    the samples rows of df with the smallest hash rank of their index, in rank
+    order: a fixed shuffle whose samples nest across sizes.  See splits.downsample
     args:
-        samples: number of samples
+        samples: number of samples, or None for all rows
     '''
-    #random seed 9 makes sure we always get the same shuffle.
-    np.random.seed(9)
-    assert df.shape[0]>2
-    df = df.reindex(np.random.permutation(df.index)).copy()
-
-    if samples is not None:
-        assert samples<=df.shape[0]
-        sampleDF = df.iloc[:samples,:]
-    else:
-        sampleDF = df
-    return sampleDF
+    return splits.downsample(df,samples)
 
 def train_val_split(df,val_portion):
     '''
-    split dataframe into validation and training sets
+    split dataframe into validation and training sets by a hash of each row's
+    index, so a product stays on its side whatever sample it is in
     
     args:
         df: data frame to split
@@ -50,41 +56,47 @@ def train_val_split(df,val_portion):
         valDF  
     '''
     assert val_portion<1 and val_portion>0
-    val_samples = int(df.shape[0]*val_portion)
-    train_samples = df.shape[0] - val_samples
-    trainDF = df.iloc[:train_samples,:]
-    valDF = df.iloc[train_samples:train_samples+val_samples,:]
+    trainDF,valDF = splits.split(df,val_portion)
 
     assert valDF.shape[0] + trainDF.shape[0] == df.shape[0]
     assert valDF.shape[1]==trainDF.shape[1]
     return trainDF, valDF
 
-def get_brand_index(trainDF,valDF,testDF):
+def fit_brand_list(trainDF):
     '''
-    converts brand names to indexes.  Unknown brands get coded zero
+    brand vocabulary from the training set. Index 0 ('NA') is for unknown brands
     '''
-    def apply_brand_index(brand,brand_list):
-        if brand in brand_list:
-            return brand_list.index(brand)
-        else:
-            return 0
-        
     brands = list(trainDF.brand.unique())
     #add a zero for unknowns
     brands.insert(0, 'NA')
+    return brands
 
-    trainDF['brand_num']=trainDF.brand.apply(apply_brand_index,args=[brands])
-    valDF['brand_num']=valDF.brand.apply(apply_brand_index,args=[brands])
-    testDF['brand_num']=testDF.brand.apply(apply_brand_index,args=[brands])
-    
-    trainDF['brand_num'].fillna(0, inplace=True)
-    valDF['brand_num'].fillna(0, inplace=True)
-    testDF['brand_num'].fillna(0, inplace=True)
+def encode_brands(brand_series,brand_list):
+    '''
+    vectorised hash lookup of each brand's position in brand_list.
+    Brands not in the list get 0
+    '''
+    lookup = pd.Series(np.arange(len(brand_list)),index=brand_list)
+    #keep the first position if a brand appears twice, as list.index would
+    lookup = lookup[~lookup.index.duplicated()]
+    positions = lookup.index.get_indexer(brand_series.values)
+    return np.where(positions>=0,lookup.values[positions],0)
+
+def get_brand_index(trainDF,valDF,testDF):
+    '''
+    converts brand names to indexes.  Unknown brands get coded zero
+    '''
+    brands = fit_brand_list(trainDF)
+
+    trainDF['brand_num']=encode_brands(trainDF.brand,brands)
+    valDF['brand_num']=encode_brands(valDF.brand,brands)
+    testDF['brand_num']=encode_brands(testDF.brand,brands)
     return brands
 
-def build_brand_matrices(trainDF, valDF, testDF):
+def build_brand_matrices(trainDF, valDF, testDF, datadir, sparse=False):
     '''
     one-hot encode brand indexes
+    if sparse, the matrices stay scipy CSR instead of dense arrays
     '''
     brand_list = get_brand_index(trainDF,valDF,testDF)
     with open(datadir + 'brand_list.pkl','wb') as f:
@@ -93,59 +105,127 @@ def build_brand_matrices(trainDF, valDF, testDF):
     plog("Building brand matrices...")
     enc = OneHotEncoder()
     train_vect = np.reshape(trainDF.brand_num.values,(-1,1))
-    brands_train = enc.fit_transform(train_vect).toarray()
+    brands_train = enc.fit_transform(train_vect)
 
     val_vect = np.reshape(valDF.brand_num.values,(-1,1))    
-    brands_val = enc.transform(val_vect).toarray()
+    brands_val = enc.transform(val_vect)
 
     test_vect = np.reshape(testDF.brand_num.values,(-1,1))
-    brands_test = enc.transform(test_vect).toarray()
-    return (brands_train, brands_val, brands_test)
+    brands_test = enc.transform(test_vect)
+    brand_matrices = (brands_train.tocsr(), brands_val.tocsr(), brands_test.tocsr())
+    if not sparse:
+        brand_matrices = tuple(m.toarray() for m in brand_matrices)
+    return brand_matrices
 
 #Get text data
-def build_text_matrices(datadir, tokenizer_path, trainDF, valDF, testDF):
+def build_text_matrices(datadir, tokenizer_path, trainDF, valDF, testDF, sparse=False, num_processes=1,
+        hash_buckets=None, hash_signed=True):
     '''
     use bag-of-words representation to convert descriptions into bag-of-words matrices
+    if sparse, the matrices are scipy CSR
+    num_processes: worker processes for bag_of_words.texts_to_csr
+    hash_buckets: if set, hash words into this many columns with a
+        bag_of_words.HashingVectorizer instead of loading the fitted tokenizer
     '''
     plog("Building text matrices...")
-    with open(tokenizer_path) as f:
-        tokenizer=pkl.load(f)
+    vectorizer = text_vectorizer(tokenizer_path,hash_buckets,hash_signed)
     train_text_matrix_path=datadir + 'train_text.pkl'
     val_text_matrix_path=datadir + 'val_text.pkl'
     test_text_matrix_path=datadir + 'test_text.pkl'
 
-    bow_train, idx_train = bag_of_words.series_to_bag_of_words(trainDF.description_clean,tokenizer,train_text_matrix_path,mode="binary")
-    bow_val, idx_val = bag_of_words.series_to_bag_of_words(valDF.description_clean,tokenizer,val_text_matrix_path,mode="binary")
-    bow_test, idx_test = bag_of_words.series_to_bag_of_words(testDF.description_clean,tokenizer,test_text_matrix_path,mode="binary")
+    bow_train, idx_train = bag_of_words.series_to_bag_of_words(trainDF.description_clean,vectorizer,train_text_matrix_path,mode="binary",sparse=sparse,num_processes=num_processes)
+    bow_val, idx_val = bag_of_words.series_to_bag_of_words(valDF.description_clean,vectorizer,val_text_matrix_path,mode="binary",sparse=sparse,num_processes=num_processes)
+    bow_test, idx_test = bag_of_words.series_to_bag_of_words(testDF.description_clean,vectorizer,test_text_matrix_path,mode="binary",sparse=sparse,num_processes=num_processes)
 
     plog("bow_train type: %s" %type(bow_train))
     return (bow_train, bow_val, bow_test)
 
-#TODO: modify this to only load a batch of images at a time, from a csv or mmap instead of pickle
-def get_image_matrices(train_imagepath,test_imagepath, trainDF, valDF, testDF):
+def text_vectorizer(tokenizer_path,hash_buckets=None,hash_signed=True):
+    '''
+    HashingVectorizer with hash_buckets buckets if that is set, else a
+    Vectorizer over the tokenizer pickled at tokenizer_path
+    '''
+    if hash_buckets is not None:
+        return bag_of_words.HashingVectorizer(hash_buckets,hash_signed)
+    with open(tokenizer_path) as f:
+        return bag_of_words.Vectorizer(pkl.load(f))
+
+def open_image_features(imagepath):
     '''
-    load images from pkl files and convert to matrices
+    feature store for imagepath.  A pickled DataFrame is converted to a store
+    next to it, with the same name minus .pkl, and the store is used after
+    that until the pickle changes
     '''
+    if feature_store.is_feature_store(imagepath):
+        return feature_store.FeatureSink(imagepath)
+    store_path = os.path.splitext(imagepath)[0]
+    if not feature_store.is_converted(store_path,imagepath):
+        plog("Converting %s to feature store %s..." %(imagepath,store_path))
+        return feature_store.pickle_to_feature_store(imagepath,store_path)
+    return feature_store.FeatureSink(store_path)
+
+def image_features_input(imagepath):
+    '''
+    [store path, signature] of the feature store for imagepath, for cache
+    key params.  A pickle is converted first, so the key is the same on every
+    run, and the signature covers the manifest and every shard file
+    '''
+    store = open_image_features(imagepath)
+    return [store.path,store.signature()]
 
+def drop_rows_without_images(train_imagepath,test_imagepath,trainDF,valDF,testDF):
+    '''
+    the data frames without the rows that have no extracted image features,
+    so those rows are not trained and scored on as all-zero image vectors.
+    Only the stores' row ids are read
+    returns:
+        trainDF, valDF, testDF
+    '''
+    store = open_image_features(train_imagepath)
+    test_store = open_image_features(test_imagepath) if test_imagepath is not None else None
+    dfs = []
+    for name,df,split_store in [('train',trainDF,store),('val',valDF,store),('test',testDF,test_store)]:
+        if split_store is not None:
+            found = split_store.has_rows(df.index.values)
+            if not found.all():
+                plog("Dropping %i of %i %s rows without image features" %((~found).sum(),len(found),name))
+            df = df[found]
+        dfs.append(df)
+    assert dfs[0].shape[0]>0, "no training rows have image features in %s" %train_imagepath
+    return dfs
+
+def get_image_matrices(train_imagepath,test_imagepath, trainDF, valDF, testDF, return_masks=False):
+    '''
+    look up the image features of each row by its index in memory-mapped
+    feature stores, so the rows may be in any order or sample size.
+    Rows without features get zeros.
+
+    args:
+        return_masks: if True, also return a bool mask per split that is False
+            for rows that had no features
+    '''
     plog("Loading train image features from %s..." %train_imagepath)
-    with open(train_imagepath,'rb') as f:
-        imageDF=pkl.load(f)
+    store = open_image_features(train_imagepath)
+    train_image_matrix,train_mask = store.lookup(trainDF.index.values)
+    val_image_matrix,val_mask = store.lookup(valDF.index.values)
     
     if test_imagepath is not None:
         plog("Loading test image features from %s..." %test_imagepath)
-        with open(test_imagepath,'rb') as f:
-            test_imageDF = pkl.load(f)
-
-        test_image_matrix = test_imageDF.as_matrix()
-        test_image_matrix = test_image_matrix[:testDF.shape[0],:]
+        test_store = open_image_features(test_imagepath)
+        test_image_matrix,test_mask = test_store.lookup(testDF.index.values)
         assert test_image_matrix.shape[0]==testDF.shape[0]
-    else: test_image_matrix=None
+    else:
+        test_image_matrix=None
+        test_mask=None
 
-    image_matrix = imageDF.as_matrix()
-    train_image_matrix = image_matrix[:trainDF.shape[0],:]
-    val_image_matrix = image_matrix[trainDF.shape[0]:trainDF.shape[0] + valDF.shape[0],:]
+    for name,mask in [('train',train_mask),('val',val_mask),('test',test_mask)]:
+        if mask is not None and not mask.all():
+            plog("%i of %i %s rows have no image features" %((~mask).sum(),len(mask),name))
 
-    return (train_image_matrix, val_image_matrix, test_image_matrix)
+    image_matrices = (train_image_matrix, val_image_matrix, test_image_matrix)
+    if return_masks:
+        return image_matrices, (train_mask, val_mask, test_mask)
+    return image_matrices
 
 
 def get_targets(df):
@@ -159,32 +239,64 @@ def get_targets(df):
 
 
 
-def conditional_hstack(other,bow,image,dataset_name):
+def assemble_features(blocks):
     '''
-    assumes other is present.
-    if bag of words is not none, hstack it
-    if image is not None, hstack it
-    '''
-    if other is not None:
-        X=other
-        if bow is not None:
-            assert bow.shape[0]==X.shape[0]
-            X = np.hstack((X,bow))
-        else:
-            plog("Bag of words data missing from %s" %dataset_name)
-        if image is not None:
-            assert image.shape[0]==X.shape[0]
-            X = np.hstack((X,image))
+    lay the blocks out side by side in one preallocated float32 matrix.  The
+    column layout is worked out from the block shapes first, and each block is
+    written into its slice of the output, so no intermediate stacks are made.
+    If every block is sparse the result is a float32 CSR matrix instead.  Sparse
+    blocks next to a dense one (the image features) are scattered into the dense
+    output, as CSR of the dense columns would take about twice their dense size
+    args:
+        blocks: list of 2D arrays or sparse matrices with the same number of rows
+    returns:
+        X: (n_rows, sum of block widths) float32
+    '''
+    n_rows = blocks[0].shape[0]
+    for block in blocks:
+        assert block.shape[0]==n_rows, "block has %i rows, expected %i" %(block.shape[0],n_rows)
+    if all(scipy.sparse.issparse(b) for b in blocks):
+        return scipy.sparse.hstack(blocks,format='csr',dtype=np.float32)
+
+    X = np.empty((n_rows,sum(block.shape[1] for block in blocks)),dtype=np.float32)
+    col = 0
+    for block in blocks:
+        width = block.shape[1]
+        if scipy.sparse.issparse(block):
+            #only the nonzeros are written, so the block is never densified whole
+            block = scipy.sparse.coo_matrix(block)
+            block.sum_duplicates()
+            X[:,col:col+width] = 0
+            X[block.row,col+block.col] = block.data
         else:
-            plog("Image data missing from %s" %dataset_name)
+            X[:,col:col+width] = block
+        col += width
     return X
 
+def conditional_hstack(other,bow,image,dataset_name):
+    '''
+    assumes other is present.
+    if bag of words is not none, add its columns
+    if image is not None, add its columns
+    returns: float32 matrix from assemble_features, sparse if all of the blocks are
+    '''
+    blocks = [other]
+    if bow is not None:
+        blocks.append(bow)
+    else:
+        plog("Bag of words data missing from %s" %dataset_name)
+    if image is not None:
+        blocks.append(image)
+    else:
+        plog("Image data missing from %s" %dataset_name)
+    return assemble_features(blocks)
+
 def merge_data(bows,images,others):
     '''
     merge together the datasets to be used in the model
     args:
         sets: list of datasets to be used
-    returns: 2D float32 numpyarrays
+    returns: 2D float32 numpyarrays, or CSR matrices if every block is sparse
     '''
     #HACK: splitting None into 3
     if bows is None:
@@ -197,14 +309,15 @@ def merge_data(bows,images,others):
     X_val = conditional_hstack(others[1],bows[1],images[1],'val')
     X_test = conditional_hstack(others[2],bows[2],images[2],'test')
 
-    return X_train.astype(np.float32), X_val.astype(np.float32), X_test.astype(np.float32)
+    return X_train, X_val, X_test
     
 
 def prepDFs(datadir,
         train_samples=10000,
         test_samples=1000,
         val_portion=0.1,
-        debug=False):
+        debug=False,
+        columns=None):
     '''
     1. run train_val_split on training
     1b. run shuffle on test
@@ -215,6 +328,8 @@ def prepDFs(datadir,
         a. extract image data
     4. merge datasets
 
+    columns: csv columns to load, or None for all
+
     returns: X_train,y_train,X_val,y_val,X_test,y_test
     '''
     if(debug):
@@ -227,9 +342,9 @@ def prepDFs(datadir,
         testpath = datadir + 'test_set.csv'
 
     plog("Loading train csv...")
-    trainDF = pd.read_csv(trainpath,header = 0, index_col = 0,low_memory = False)
+    trainDF = table_store.read_csv_columns(trainpath,columns)
     plog("Loading test csv...")
-    testDF = pd.read_csv(testpath,header = 0, index_col = 0,low_memory = False)
+    testDF = table_store.read_csv_columns(testpath,columns)
 
     trainDF = shuffle_and_downsample(trainDF,train_samples)
     testDF = shuffle_and_downsample(testDF,test_samples)
@@ -243,7 +358,12 @@ def main(datadir,
         use_text=True,
         train_image_fn='train_image_features_0_2500.pkl',
         test_image_fn='test_image_features_0_2500.pkl',
-        debug=False):
+        debug=False,
+        sparse=False,
+        cache_max_gb=20,
+        hash_buckets=None,
+        num_processes=None,
+        drop_missing_images=True):
     '''
     1. run train_val_split on training
     1b. run shuffle on test
@@ -254,6 +374,17 @@ def main(datadir,
         a. extract image data
     4. merge datasets
 
+    if sparse, brand and bag-of-words blocks stay scipy CSR and so do the X's,
+    unless use_images adds the dense image block, when the X's are dense
+    results are cached in datadir/model_data_cache/, keyed by the parameters and
+    the contents of the input files, and come back memory-mapped on a hit.
+    The cache keeps at most cache_max_gb, evicting least recently used entries
+    if hash_buckets is set, text is featurised by the hashing trick into that
+    many columns and no tokenizer is needed
+    num_processes: worker processes for the bag of words, or None for one per cpu
+    if drop_missing_images, rows with no extracted image features are dropped
+    from every split when use_images, instead of getting all-zero image features
+
     returns: X_train,y_train,X_val,y_val,X_test,y_test
     '''
 
@@ -271,14 +402,24 @@ def main(datadir,
         train_imagepath = datadir + train_image_fn
         test_imagepath = datadir + test_image_fn
 
+    tokenizer_path = 'tokenizer_5000.pkl'
+
     dstart=datetime.now()
     plog("Checking to see if prepped data already available...")
-    outpath = datadir + 'model_data_%i_%r_%s_%s.pkl'%(train_samples,val_portion,use_images,use_text)
-    if os.path.exists(outpath):
-        plog("Data found.  Loading...")
-        with open(outpath,'rb') as f:
-            data,n_values = pkl.load(f)
-
+    cache = data_cache.ModelDataCache(datadir + 'model_data_cache/',cache_max_gb*1024**3)
+    params = {'train_samples':train_samples,'test_samples':test_samples,'val_portion':val_portion,
+              'use_images':use_images,'use_text':use_text,'sparse':sparse,'hash_buckets':hash_buckets,
+              'drop_missing_images':drop_missing_images,'version':CACHE_VERSION}
+    inputs = {'train_csv':trainpath,'test_csv':testpath}
+    if use_text and hash_buckets is None:
+        inputs['tokenizer'] = tokenizer_path
+    if use_images:
+        params['train_images'] = image_features_input(train_imagepath)
+        params['test_images'] = image_features_input(test_imagepath)
+    cache_key = cache.key(params,inputs)
+    cached = cache.get(cache_key)
+    if cached is not None:
+        data,n_values = cached
         dfin = datetime.now()
         plog("Data loading time: %s" %(dfin-dstart))
         return data,n_values
@@ -287,17 +428,22 @@ def main(datadir,
 
 
     plog("Loading train csv...")
-    trainDF = pd.read_csv(trainpath,header = 0, index_col = 0,low_memory = False)
+    trainDF = table_store.read_csv_columns(trainpath,MODEL_COLUMNS)
     plog("Loading test csv...")
-    testDF = pd.read_csv(testpath,header = 0, index_col = 0,low_memory = False)
+    testDF = table_store.read_csv_columns(testpath,MODEL_COLUMNS)
 
     trainDF = shuffle_and_downsample(trainDF,train_samples)
     trainDF,valDF = train_val_split(trainDF,val_portion)
     testDF = shuffle_and_downsample(testDF,test_samples)
+    if use_images and drop_missing_images:
+        trainDF,valDF,testDF = drop_rows_without_images(train_imagepath,test_imagepath,trainDF,valDF,testDF)
     #Load text data
     t0 = datetime.now()
     if use_text:
-        bow_data=build_text_matrices(datadir, 'tokenizer_5000.pkl', trainDF, valDF, testDF)
+        if num_processes is None:
+            num_processes = multiprocessing.cpu_count()
+        bow_data=build_text_matrices(datadir, tokenizer_path, trainDF, valDF, testDF, sparse,
+                                     num_processes, hash_buckets=hash_buckets)
         t1 = datetime.now()
         plog("Time to load text: %s" %str(t1-t0))
     else:
@@ -317,7 +463,7 @@ def main(datadir,
     y1_val,y2_val,y3_val=get_targets(valDF)
     y1_test,y2_test,y3_test=get_targets(testDF)
 
-    other_data = build_brand_matrices(trainDF, valDF, testDF)
+    other_data = build_brand_matrices(trainDF, valDF, testDF, datadir, sparse)
 
     X_train,X_val,X_test = merge_data(bow_data,image_data,other_data)
 
@@ -330,15 +476,205 @@ def main(datadir,
     n_values = dict(zip(keys,values))
     data = (train_data, val_data, test_data)
 
-    plog("Data loaded.  Saving to %s" %outpath)
-    with open(outpath,'wb') as f:
-        pkl.dump((data,n_values),f)
+    plog("Data loaded.  Saving to cache...")
+    cache.put(cache_key,data,n_values)
 
     dfin = datetime.now()
     plog("Data loading time: %s" %(dfin-dstart))
 
     return data,n_values
 
+def iter_csv_blocks(csv_path,chunk_rows,val_portion=None,sample_fraction=None):
+    '''
+    stream a catalogue csv in blocks of chunk_rows rows, keeping MODEL_COLUMNS.
+    If val_portion is given, each row is also assigned to validation as in
+    train_val_split, from a hash of its index, so every pass agrees.
+    If sample_fraction is given, only rows in splits.in_sample are kept, so
+    smaller fractions give nested subsets
+    yields:
+        block: data frame of up to chunk_rows rows, indexed like the csv
+        is_val: (len(block),) bool, all False if val_portion is None
+    '''
+    reader = pd.read_csv(csv_path,header = 0, index_col = 0,chunksize=chunk_rows)
+    for block in reader:
+        block = block[MODEL_COLUMNS]
+        if sample_fraction is not None:
+            block = block[splits.in_sample(block.index.values,sample_fraction)]
+        if val_portion is None:
+            is_val = np.zeros(block.shape[0],dtype=bool)
+        else:
+            is_val = splits.assign(block.index.values,val_portion)==splits.VAL
+        yield block,is_val
+
+def fit_brand_list_chunked(trainpath,chunk_rows,val_portion,sample_fraction=None):
+    '''
+    fit_brand_list over the training rows of a csv that is read in blocks
+    '''
+    uniques = []
+    for block,is_val in iter_csv_blocks(trainpath,chunk_rows,val_portion,sample_fraction):
+        uniques.append(block.brand.values[~is_val])
+        uniques = [pd.unique(np.concatenate(uniques))]
+    brands = list(uniques[0]) if uniques else []
+    brands.insert(0, 'NA')
+    return brands
+
+def block_features(block,brand_list,vectorizer,image_store):
+    '''
+    dense float32 feature rows of one block: the brand one-hot, whose column 0
+    marks brands not seen in training, then bag of words and image features if
+    vectorizer (from text_vectorizer) and image_store are not None
+    '''
+    n = block.shape[0]
+    brand_num = encode_brands(block.brand,brand_list)
+    brands = np.zeros((n,len(brand_list)),dtype=np.float32)
+    brands[np.arange(n),brand_num] = 1
+    blocks = [brands]
+    if vectorizer is not None:
+        blocks.append(vectorizer.transform(block.description_clean,"binary").toarray())
+    if image_store is not None:
+        blocks.append(image_store.lookup(block.index.values)[0])
+    return assemble_features(blocks)
+
+def write_chunked_split(sinks,block,brand_list,vectorizer,image_store,drop_missing_images=True):
+    '''
+    append one block's feature and target rows to a split's (X, y) sinks,
+    as the next shard of each so the two stay row-aligned.  If
+    drop_missing_images, rows that image_store has no features for are left out
+    '''
+    if image_store is not None and drop_missing_images:
+        block = block[image_store.has_rows(block.index.values)]
+    if block.shape[0]==0:
+        return np.zeros((0,3),dtype=np.int32)
+    X_sink,y_sink = sinks
+    iloc0 = y_sink.committed_rows
+    iloc1 = iloc0 + block.shape[0]
+    y = np.column_stack(get_targets(block))
+    X_sink.append(block.index.values,block_features(block,brand_list,vectorizer,image_store),iloc0,iloc1)
+    y_sink.append(block.index.values,y,iloc0,iloc1)
+    return y
+
+def open_chunked_data(outdir):
+    '''
+    returns:
+        data: ((X, y1, y2, y3) for train, val and test) as feature_store.StoreRows
+            views, read a minibatch at a time by models.iterate_minibatches
+        n_values
+    '''
+    data = []
+    for split in ['train','val','test']:
+        X_sink = feature_store.FeatureSink(outdir + split + '_X/')
+        y_sink = feature_store.FeatureSink(outdir + split + '_y/',np.int32)
+        data.append((feature_store.StoreRows(X_sink),) + \
+            tuple(feature_store.StoreRows(y_sink,column=i) for i in range(3)))
+    with open(outdir + 'n_values.pkl','rb') as f:
+        n_values = pkl.load(f)
+    return tuple(data),n_values
+
+def main_chunked(datadir,
+        val_portion=0.1,
+        use_images=True,
+        use_text=True,
+        train_image_fn='train_image_features_0_2500.pkl',
+        test_image_fn='test_image_features_0_2500.pkl',
+        chunk_rows=50000,
+        dtype=np.float32,
+        sample_fraction=None,
+        hash_buckets=None,
+        drop_missing_images=True):
+    '''
+    out-of-core version of main for the full catalogue.  The csvs are streamed
+    chunk_rows rows at a time, in csv order, and validation rows and any
+    sample are picked by hash as in iter_csv_blocks.
+    1. fit the brand list on one pass over the training rows
+    2. per block, encode brands, apply the fitted tokenizer, look up image
+       features and append the feature rows and targets as the next shard of
+       the split's feature stores
+    Nothing bigger than one block is held in memory.  The stores go to
+    datadir/chunked_model_data/[key]/, keyed like the main cache, and are
+    reused if they are already complete
+
+    args:
+        dtype: np.float32 or np.float16 for the stored feature rows
+        sample_fraction: keep about this fraction of the train and test rows,
+            or None for all of them
+        hash_buckets: hash text into this many columns instead of using the
+            tokenizer.  Rows are stored dense, so keep it to a few thousand
+        drop_missing_images: leave out rows with no image features, as in main
+    returns: data,n_values like main, with the arrays as feature_store.StoreRows
+    '''
+    trainpath = datadir + 'train_set.csv'
+    testpath = datadir + 'test_set.csv'
+    train_imagepath = datadir + train_image_fn
+    test_imagepath = datadir + test_image_fn
+    tokenizer_path = 'tokenizer_5000.pkl'
+
+    dstart=datetime.now()
+    cache = data_cache.ModelDataCache(datadir + 'model_data_cache/')
+    params = {'chunked':True,'val_portion':val_portion,'use_images':use_images,'use_text':use_text,
+              'chunk_rows':chunk_rows,'dtype':np.dtype(dtype).name,'sample_fraction':sample_fraction,
+              'hash_buckets':hash_buckets,'drop_missing_images':drop_missing_images,'version':CACHE_VERSION}
+    inputs = {'train_csv':trainpath,'test_csv':testpath}
+    if use_text and hash_buckets is None:
+        inputs['tokenizer'] = tokenizer_path
+    if use_images:
+        params['train_images'] = image_features_input(train_imagepath)
+        params['test_images'] = image_features_input(test_imagepath)
+    outdir = datadir + 'chunked_model_data/' + cache.key(params,inputs) + '/'
+    if os.path.exists(outdir + 'complete'):
+        plog("Chunked model data already prepared in %s" %outdir)
+        return open_chunked_data(outdir)
+
+    plog("Preparing chunked model data in %s..." %outdir)
+    tmp = outdir[:-1] + '.tmp%i/' %os.getpid()
+    os.makedirs(tmp)
+
+    plog("Fitting brand list...")
+    brand_list = fit_brand_list_chunked(trainpath,chunk_rows,val_portion,sample_fraction)
+    with open(tmp + 'brand_list.pkl','wb') as f:
+        pkl.dump(brand_list,f)
+
+    vectorizer = None
+    if use_text:
+        vectorizer = text_vectorizer(tokenizer_path,hash_buckets)
+    train_images = None
+    test_images = None
+    if use_images:
+        train_images = open_image_features(train_imagepath)
+        test_images = open_image_features(test_imagepath)
+
+    sinks = {}
+    empty = pd.DataFrame(columns=MODEL_COLUMNS)
+    for split,images in [('train',train_images),('val',train_images),('test',test_images)]:
+        sinks[split] = (feature_store.FeatureSink(tmp + split + '_X/',dtype),
+                        feature_store.FeatureSink(tmp + split + '_y/',np.int32))
+        #recorded up front, so a split that gets no rows still opens as (0, width)
+        sinks[split][0].set_n_features(block_features(empty,brand_list,vectorizer,images).shape[1])
+        sinks[split][1].set_n_features(3)
+
+    y_max = np.zeros(3,dtype=np.int64)
+    for i,(block,is_val) in enumerate(iter_csv_blocks(trainpath,chunk_rows,val_portion,sample_fraction)):
+        y = write_chunked_split(sinks['train'],block[~is_val],brand_list,vectorizer,train_images,drop_missing_images)
+        if len(y)>0:
+            y_max = np.maximum(y_max,y.max(axis=0))
+        write_chunked_split(sinks['val'],block[is_val],brand_list,vectorizer,train_images,drop_missing_images)
+        plog("Train block %i: %i rows" %(i,block.shape[0]))
+    for i,(block,is_val) in enumerate(iter_csv_blocks(testpath,chunk_rows,sample_fraction=sample_fraction)):
+        write_chunked_split(sinks['test'],block,brand_list,vectorizer,test_images,drop_missing_images)
+        plog("Test block %i: %i rows" %(i,block.shape[0]))
+
+    n_values = dict(zip(['y_1','y_2','y_3'],[int(m)+1 for m in y_max]))
+    with open(tmp + 'n_values.pkl','wb') as f:
+        pkl.dump(n_values,f)
+    open(tmp + 'complete','w').close()
+    if os.path.exists(outdir):
+        shutil.rmtree(tmp)
+    else:
+        os.rename(tmp[:-1],outdir[:-1])
+
+    dfin = datetime.now()
+    plog("Data preparation time: %s" %(dfin-dstart))
+    return open_chunked_data(outdir)
+
 if __name__ == '__main__':
     home = os.path.join(os.path.dirname(__file__),'..')
     datadir = os.path.join(home,'data') + '/'
@@ -347,17 +683,24 @@ if __name__ == '__main__':
                             train_samples=None,
                             test_samples=100,
                             val_portion=0.1,
-                            debug=False)
+                            debug=False,
+                            columns=['large_image_URL'])
 
     df=trainDF
     dataset="train"
-    iloc0=67500
+    iloc0=0
     iloc1=200000
     save_freq=10
     batch_size = 250
-    out_pickle_name=dataset+'_image_features/'+dataset+'_image_features'
 
     import image_processing
+    #usage: python data_prep.py [shard_id num_shards], e.g. python data_prep.py $PBS_ARRAYID 8
+    if len(sys.argv)>2:
+        shard_id = int(sys.argv[1])
+        num_shards = int(sys.argv[2])
+        iloc0,iloc1 = image_processing.get_shard_range(iloc0,iloc1,num_shards,shard_id,batch_size)
+    out_pickle_name=dataset+'_image_features/'+dataset+'_image_features_%i_%i' %(iloc0,iloc1)
+
     image_processing.get_selected_image_features(df,
                                 datadir,
                                 dataset,
@@ -367,4 +710,4 @@ if __name__ == '__main__':
                                 out_pickle_name,
                                 batch_size,
                                 width=224,
-                                filetype='jpg')
\ No newline at end of file
+                                filetype='jpg')
@@ -8,24 +8,57 @@ from datetime import datetime
 import pandas as pd
 import numpy as np
 import cPickle as pkl
+import time
+import threading
+import multiprocessing
+import Queue
+import httplib
+import urlparse
+import socket
 
 #image downloading and processing
 import urllib
 import io
 import matplotlib.pyplot as plt
 import skimage.transform
+from PIL import Image
 
-def download_and_resize(url,width):
+import image_store
+import table_store
+
+RESIZE_BACKENDS = ('skimage','pil')
+
+def download_and_resize(url,width,backend='skimage'):
     '''
     download image url, resize and crop to [width]
     args:
         url: url of image
         width: width of square image
+        backend: 'skimage' or 'pil'. See decode_and_resize
+    returns:
+        rawim: image cropped and resized to width square
+    '''
+    return decode_and_resize(urllib.urlopen(url).read(),url,width,backend)
+
+def decode_and_resize(data,url,width,backend='skimage'):
+    '''
+    decode downloaded image bytes, resize and crop to [width]
+    args:
+        data: raw bytes of the image file
+        url: url of image (used for the file extension)
+        width: width of square image
+        backend: 'skimage' resizes in float through skimage.transform.
+            'pil' uses JPEG draft decoding and uint8 resampling, which is much
+            faster and differs from 'skimage' by a few intensity levels per pixel
     returns:
         rawim: image cropped and resized to width square
     '''
+    assert backend in RESIZE_BACKENDS
+    if backend=='pil':
+        return decode_and_resize_pil(data,width)
+
     ext = url.split('.')[-1]
-    im = plt.imread(io.BytesIO(urllib.urlopen(url).read()), ext)
+    im = plt.imread(io.BytesIO(data), ext)
     # Resize so smallest dim = 256, preserving aspect ratio
     h, w, _ = im.shape
     if h < w:
@@ -42,7 +75,34 @@ def download_and_resize(url,width):
     rawim = im.astype('uint8')
     return rawim
 
-def prep_image(url,idx,dataset,datadir,width=224,filetype='jpg',verbose=False):
+def decode_and_resize_pil(data,width):
+    '''
+    same resize and central crop as decode_and_resize, done in uint8 with PIL.
+    For JPEGs, draft mode lets the decoder skip straight to the smallest
+    power-of-two reduction that is still at least [width] on the short side.
+    '''
+    im = Image.open(io.BytesIO(data))
+    w, h = im.size
+    if h < w:
+        size = (w*width/h, width)
+    else:
+        size = (width, h*width/w)
+    im.draft('RGB', size)
+    im = im.convert('RGB').resize(size, Image.BILINEAR)
+
+    # Central crop to width x width
+    halfwidth = width/2
+    w, h = im.size
+    im = im.crop((w//2-halfwidth, h//2-halfwidth, w//2+halfwidth, h//2+halfwidth))
+    return np.asarray(im, dtype=np.uint8)
+
+def image_path(idx,dataset,datadir,width=224,filetype='jpg'):
+    '''
+    path of the cached image file, datadir/images/[dataset]_[idx]_w[width].[filetype]
+    '''
+    return datadir + 'images/' + dataset + '_' +  str(idx) + '_w' + str(width) + '.' + filetype
+
+def prep_image(url,idx,dataset,datadir,width=224,filetype='jpg',verbose=False,resize_backend='skimage'):
     '''
     Check to see image file has been downloaded at current size.  If it has not,
     download and resize image. Saves file to datadir/images/[dataset]_[idx]_w[width].[filetype]
@@ -54,16 +114,17 @@ def prep_image(url,idx,dataset,datadir,width=224,filetype='jpg',verbose=False):
         dataset: string 'train' or 'test' or other identifier
         datadir: data directory
         width: desired width of image. Will be resized to width squared
+        resize_backend: 'skimage' or 'pil'. See decode_and_resize
     returns:
         rawim: scaled and cropped image
     '''
-    outpath = datadir + 'images/' + dataset + '_' +  str(idx) + '_w' + str(width) + '.' + filetype
+    outpath = image_path(idx,dataset,datadir,width,filetype)
 
     if not os.path.isfile(outpath):
         if verbose:
             print "downloading image #%s..." %str(idx)
         try:
-            rawim = download_and_resize(url,width)
+            rawim = download_and_resize(url,width,resize_backend)
             plt.imsave(outpath,rawim)
             return rawim
         except:
@@ -75,24 +136,318 @@ def prep_image(url,idx,dataset,datadir,width=224,filetype='jpg',verbose=False):
         rawim = plt.imread(outpath)
         return rawim
         
-def get_selected_images(csv_name,first_idx,last_idx,dataset,datadir,width=224,filetype='jpg'):
+class HTTPError(IOError):
+    '''
+    non-200 response to an image request
+    '''
+    def __init__(self,status,url):
+        IOError.__init__(self,"HTTP %i for url %s" %(status,url))
+        self.status = status
+
+def is_retryable(error):
+    '''
+    True for errors worth another attempt: dropped connections, timeouts and
+    5xx responses.  4xx responses and bad urls fail at once
+    '''
+    if isinstance(error,HTTPError):
+        return error.status>=500
+    if isinstance(error,httplib.InvalidURL):
+        return False
+    return isinstance(error,(socket.error,httplib.HTTPException))
+
+class RateLimiter(object):
+    '''
+    caps the number of requests per second shared across all download threads
+    '''
+    def __init__(self,max_rate=None):
+        self.interval = 1.0/max_rate if max_rate else 0.
+        self.next_time = time.time()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.time()
+            wait_time = self.next_time - now
+            self.next_time = max(now,self.next_time) + self.interval
+        if wait_time>0:
+            time.sleep(wait_time)
+
+def fetch_url(url,connections,timeout=30,max_redirects=3):
+    '''
+    download url over a kept-alive connection to its host
+
+    args:
+        url: url of image
+        connections: dict of (scheme,host) -> open httplib connection, owned by one thread
+        timeout: socket timeout in seconds
+        max_redirects: number of redirects to follow
+    returns:
+        data: raw bytes of the response body
+    '''
+    parts = urlparse.urlsplit(url)
+    key = (parts.scheme,parts.netloc)
+    conn = connections.get(key)
+    if conn is None:
+        if parts.scheme=='https':
+            conn = httplib.HTTPSConnection(parts.netloc,timeout=timeout)
+        else:
+            conn = httplib.HTTPConnection(parts.netloc,timeout=timeout)
+        connections[key] = conn
+
+    path = parts.path or '/'
+    if parts.query:
+        path += '?' + parts.query
+    try:
+        conn.request('GET',path,headers={'Connection':'keep-alive'})
+        response = conn.getresponse()
+        data = response.read()
+    except:
+        #drop the connection so the next attempt reconnects
+        conn.close()
+        del connections[key]
+        raise
+
+    if response.status in (301,302,303,307,308) and max_redirects>0:
+        location = urlparse.urljoin(url,response.getheader('location'))
+        return fetch_url(location,connections,timeout,max_redirects-1)
+    if response.status!=200:
+        raise HTTPError(response.status,url)
+    return data
+
+def fetch_with_retries(url,connections,rate_limiter,max_retries=3,backoff=0.5):
+    '''
+    fetch_url, retrying with exponential backoff on errors that is_retryable.
+    raises the last error if every attempt fails, or at once if it is not retryable
+    '''
+    for attempt in range(max_retries+1):
+        rate_limiter.wait()
+        try:
+            return fetch_url(url,connections)
+        except Exception as e:
+            if attempt==max_retries or not is_retryable(e):
+                raise
+            time.sleep(backoff*2**attempt)
+
+def fetch_worker(jobs,fetched,rate_limiter,max_retries,backoff,stats,lock):
+    '''
+    thread target: take (idx,url) jobs off the queue until a None job is found,
+    and put (idx,url,data) on the bounded fetched queue for the process pool
+    '''
+    connections = {}
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+        idx,url = job
+        t0 = time.time()
+        try:
+            data = fetch_with_retries(url,connections,rate_limiter,max_retries,backoff)
+        except Exception:
+            print "unable to download image #%s from url %s..." %(idx,url)
+            with lock:
+                stats['failed'] += 1
+            continue
+        t1 = time.time()
+        fetched.put((idx,url,data))
+        with lock:
+            stats['fetched'] += 1
+            stats['fetch_time'] += t1-t0
+            stats['fetch_wait'] += time.time()-t1
+    for conn in connections.values():
+        conn.close()
+
+def resize_and_save(idx,url,data,dataset,datadir,width,filetype,resize_backend,save_file=True):
+    '''
+    process pool target: decode, resize, crop and save one fetched image
+    args:
+        save_file: if False, return the image to the parent instead of saving a jpeg
+    returns:
+        idx, result, seconds spent.  result is None if the image failed,
+        otherwise True if it was saved or the uint8 image if save_file is False
+    '''
+    t0 = time.time()
+    try:
+        rawim = decode_and_resize(data,url,width,resize_backend)
+        if save_file:
+            plt.imsave(image_path(idx,dataset,datadir,width,filetype),rawim)
+            result = True
+        else:
+            result = rawim
+    except Exception:
+        print "unable to decode image #%s from url %s..." %(idx,url)
+        result = None
+    return idx,result,time.time()-t0
+
+def download_images(image_urls,dataset,datadir,width=224,filetype='jpg',
+                    num_workers=16,num_processes=None,queue_size=64,
+                    max_retries=3,backoff=0.5,max_rate=None,resize_backend='skimage',
+                    image_store=None):
+    '''
+    download and resize images concurrently and save them to datadir/images,
+    or to image_store if one is given.
+    Images already on disk at this size are skipped, as in prep_image.
+    Fetching runs on [num_workers] threads; the fetched bytes go through a bounded
+    queue to a pool of [num_processes] processes which decode, resize and save them.
+
+    args:
+        image_urls: pandas series of urls, indexed by image row index
+        dataset: string 'train' or 'test' or other identifier
+        datadir: data directory
+        width: desired width of image. Will be resized to width squared
+        num_workers: number of download threads
+        num_processes: number of decode/resize processes. None for one per cpu
+        queue_size: maximum number of fetched images waiting to be resized
+        max_retries: attempts per image after the first one fails
+        backoff: seconds to wait before the first retry, doubled on each retry
+        max_rate: None or maximum requests per second across all threads
+        resize_backend: 'skimage' or 'pil'. See decode_and_resize
+        image_store: None or writable image_store.ImageShard covering image_urls.index
+    returns:
+        stats: dict with image counts ('cached', 'fetched', 'downloaded', 'failed')
+            and stage timings ('fetch_time', 'fetch_wait', 'process_time', 'elapsed')
+    '''
+    if num_processes is None:
+        num_processes = multiprocessing.cpu_count()
+    stats = {'cached':0,'fetched':0,'downloaded':0,'failed':0,
+             'fetch_time':0.,'fetch_wait':0.,'process_time':0.}
+    lock = threading.Lock()
+    start_time = time.time()
+
+    #start the pool before any threads so the forked processes don't inherit held locks
+    pool = multiprocessing.Pool(num_processes)
+    in_flight = threading.BoundedSemaphore(2*num_processes)
+
+    rate_limiter = RateLimiter(max_rate)
+    jobs = Queue.Queue(maxsize=4*num_workers)
+    fetched = Queue.Queue(maxsize=queue_size)
+    workers = []
+    for w in range(num_workers):
+        worker = threading.Thread(target=fetch_worker,
+                                  args=(jobs,fetched,rate_limiter,max_retries,backoff,stats,lock))
+        worker.daemon = True
+        worker.start()
+        workers.append(worker)
+
+    def feed_jobs():
+        for i,url in image_urls.iteritems():
+            if image_store is not None:
+                cached = i in image_store
+            else:
+                cached = os.path.isfile(image_path(i,dataset,datadir,width,filetype))
+            if cached:
+                with lock:
+                    stats['cached'] += 1
+            else:
+                jobs.put((i,url))
+        for worker in workers:
+            jobs.put(None)
+        for worker in workers:
+            worker.join()
+        fetched.put(None)
+    feeder = threading.Thread(target=feed_jobs)
+    feeder.daemon = True
+    feeder.start()
+
+    def on_processed(result):
+        idx,rawim,seconds = result
+        try:
+            if image_store is not None and rawim is not None:
+                try:
+                    image_store.write(idx,rgb_image(rawim))
+                except Exception as e:
+                    print "unable to store image #%s: %s" %(idx,e)
+                    rawim = None
+            with lock:
+                stats['downloaded' if rawim is not None else 'failed'] += 1
+                stats['process_time'] += seconds
+        finally:
+            #always free the slot, or the submit loop and pool.join() hang
+            in_flight.release()
+
+    while True:
+        item = fetched.get()
+        if item is None:
+            break
+        in_flight.acquire()
+        pool.apply_async(resize_and_save,
+                         item + (dataset,datadir,width,filetype,resize_backend,image_store is None),
+                         callback=on_processed)
+    pool.close()
+    pool.join()
+    feeder.join()
+    if image_store is not None:
+        image_store.flush()
+    stats['elapsed'] = time.time() - start_time
+    return stats
+
+def rgb_image(rawim):
+    '''
+    the 3 colour channels of a decoded image, as image shards store them:
+    an alpha channel is dropped and a greyscale image repeated
+    '''
+    if rawim.ndim==2:
+        rawim = np.dstack([rawim]*3)
+    return rawim[:,:,:3]
+
+def report_download_stats(stats,num_workers,num_processes=None):
+    '''
+    print per-stage throughput so the thread and process pools can be sized.
+    A stage whose capacity is well above the overall rate is over-provisioned.
+    '''
+    if num_processes is None:
+        num_processes = multiprocessing.cpu_count()
+    print "images cached: %i, downloaded: %i, failed: %i in %.1fs" %(
+        stats['cached'],stats['downloaded'],stats['failed'],stats['elapsed'])
+    if stats['fetched']>0:
+        fetch_rate = stats['fetched']/max(stats['fetch_time'],1e-9)
+        print "fetch stage: %.1f images/sec per thread, capacity %.1f images/sec with %i threads, %.1fs blocked on full queue" %(
+            fetch_rate,fetch_rate*num_workers,num_workers,stats['fetch_wait'])
+        processed = stats['fetched']
+        process_rate = processed/max(stats['process_time'],1e-9)
+        print "resize stage: %.1f images/sec per process, capacity %.1f images/sec with %i processes" %(
+            process_rate,process_rate*num_processes,num_processes)
+        print "overall: %.1f images/sec" %(processed/max(stats['elapsed'],1e-9))
+
+def get_selected_images(csv_name,first_idx,last_idx,dataset,datadir,width=224,filetype='jpg',
+                        num_workers=16,num_processes=None,max_retries=3,max_rate=None,
+                        resize_backend='skimage',use_image_store=False):
     '''
     for a given index range, download and resize the images,
-    then save to directory
+    then save to directory, or to one packed image shard
 
     args:
         csv_name: name of csv (assumed to be in datadir)
         first_idx: int or None. last index of range of images to download
         last_idx: int or None. last index of range of images to download
         dataset: string 'train' or 'test' or other identifier
+        num_workers: number of concurrent downloads
+        num_processes: number of decode/resize processes. None for one per cpu
+        max_retries: attempts per image after the first one fails
+        max_rate: None or maximum requests per second
+        resize_backend: 'skimage' or 'pil'. See decode_and_resize
+        use_image_store: if True, write to an image_store.ImageShard instead of jpegs
 
     returns:
         none
     '''
-    data = pd.read_csv(datadir+csv_name,header = 0, index_col = 0,low_memory = False)
+    data = table_store.read_csv_columns(datadir+csv_name,['large_image_URL'])
     image_urls = data.large_image_URL.loc[first_idx:last_idx]
-    for i,url in image_urls.iteritems():
-        prep_image(url,i,dataset,datadir,width,filetype)
+    if len(image_urls)==0:
+        print "no images with index in %s to %s in %s" %(first_idx,last_idx,csv_name)
+        return
+    if use_image_store:
+        path = image_store.shard_path(datadir,dataset,width,image_urls.index[0],image_urls.index[-1])
+        print "writing images to shard %s" %path
+        store = image_store.ImageShard.create(path,image_urls.index.values,width)
+    else:
+        store = None
+    stats = download_images(image_urls,dataset,datadir,width,filetype,
+                            num_workers=num_workers,num_processes=num_processes,
+                            max_retries=max_retries,max_rate=max_rate,
+                            resize_backend=resize_backend,image_store=store)
+    report_download_stats(stats,num_workers,num_processes)
 
 def main(csv_name,dataset,first_idx,last_idx):
     start_time = datetime.now()
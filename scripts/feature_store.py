@@ -0,0 +1,411 @@
+'''
+feature_store.py
+
+Append-only binary store for image features, replacing the csv dumps.
+A store is a directory of .npy shards, one per save:
+    features_[iloc0]_[iloc1].npy: (n, 4096) float32 or float16 features
+    row_ids_[iloc0]_[iloc1].npy:  (n,) data frame index of each row
+    shards.txt: one "iloc0 iloc1 n_rows" line per committed shard, in order
+    n_features.txt: width of the rows, for a store that may have no shards
+    source.json: size and mtime of the pickle a store was converted from
+A shard only counts once its line is in shards.txt, so a job killed mid-write
+leaves the store at its last committed row.
+'''
+
+import os
+import json
+import shutil
+import hashlib
+import numpy as np
+
+class FeatureSink(object):
+    '''
+    append-only writer/reader for a feature store directory
+    '''
+    def __init__(self,path,dtype=np.float32):
+        '''
+        args:
+            path: store directory, created if missing
+            dtype: np.float32 or np.float16, used for new shards
+        '''
+        if not path.endswith('/'):
+            path += '/'
+        if not os.path.exists(path):
+            os.makedirs(path)
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.manifest_path = path + 'shards.txt'
+        self.width_path = path + 'n_features.txt'
+        self.shards = read_manifest(self.manifest_path)
+        self.sorted_ids = None
+        self.sorted_positions = None
+        self.opened = {}
+        if os.path.exists(self.manifest_path) and os.path.getsize(self.manifest_path)>0:
+            with open(self.manifest_path,'rb') as f:
+                f.seek(-1,os.SEEK_END)
+                complete = f.read()=='\n'
+            if not complete:
+                #drop the partial last line so the next append starts on a fresh line
+                with open(self.manifest_path,'wb') as f:
+                    for shard in self.shards:
+                        f.write('%i %i %i\n' %shard)
+
+    @property
+    def committed_rows(self):
+        return sum(n_rows for iloc0,iloc1,n_rows in self.shards)
+
+    @property
+    def last_iloc(self):
+        '''
+        iloc1 of the last committed shard, or None for an empty store
+        '''
+        if not self.shards:
+            return None
+        return self.shards[-1][1]
+
+    def n_features(self):
+        '''
+        width of the feature rows, from the first shard or, for a store with
+        no rows, from set_n_features
+        '''
+        if self.shards:
+            iloc0,iloc1,n_rows = self.shards[0]
+            return self.open_shard(iloc0,iloc1)[1].shape[1]
+        assert os.path.exists(self.width_path), "%s is empty and has no recorded width" %self.path
+        with open(self.width_path) as f:
+            return int(f.read())
+
+    def set_n_features(self,n_features):
+        '''
+        record the width of the rows, so that a store that ends up with no rows
+        still opens as (0, n_features)
+        '''
+        with open(self.width_path + '.tmp','w') as f:
+            f.write('%i\n' %n_features)
+        os.rename(self.width_path + '.tmp',self.width_path)
+
+    def append(self,row_ids,features,iloc0,iloc1):
+        '''
+        write one shard and commit it.  The arrays are written under temporary
+        names and renamed before the manifest line is appended and synced.
+
+        args:
+            row_ids: (n,) data frame index of the rows
+            features: (n, d) feature matrix
+            iloc0, iloc1: position range of the rows in the source data frame
+        '''
+        features = np.asarray(features)
+        assert features.shape[0]==len(row_ids)
+        if self.shards:
+            assert iloc0==self.last_iloc, "shard %i_%i does not follow iloc %i" %(iloc0,iloc1,self.last_iloc)
+
+        feature_fn,row_id_fn = shard_filenames(iloc0,iloc1)
+        for fn,arr in [(feature_fn,features.astype(self.dtype)),(row_id_fn,np.asarray(row_ids))]:
+            with open(self.path + fn + '.tmp','wb') as f:
+                np.save(f,arr)
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(self.path + fn + '.tmp',self.path + fn)
+        self.commit(iloc0,iloc1,features.shape[0])
+
+    def allocate(self,iloc0,iloc1,n_features):
+        '''
+        writable memory-mapped (iloc1-iloc0, n_features) array for a shard that is
+        filled in place, e.g. by stitching.  Finish it with commit_allocated
+        '''
+        if self.shards:
+            assert iloc0==self.last_iloc, "shard %i_%i does not follow iloc %i" %(iloc0,iloc1,self.last_iloc)
+        feature_fn,row_id_fn = shard_filenames(iloc0,iloc1)
+        return np.lib.format.open_memmap(self.path + feature_fn + '.tmp',mode='w+',
+                                         dtype=self.dtype,shape=(iloc1-iloc0,n_features))
+
+    def commit_allocated(self,row_ids,features,iloc0,iloc1):
+        '''
+        flush an array from allocate, write its row ids and commit the shard
+        '''
+        assert features.shape[0]==len(row_ids)
+        features.flush()
+        feature_fn,row_id_fn = shard_filenames(iloc0,iloc1)
+        with open(self.path + row_id_fn + '.tmp','wb') as f:
+            np.save(f,np.asarray(row_ids))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(self.path + row_id_fn + '.tmp',self.path + row_id_fn)
+        os.rename(self.path + feature_fn + '.tmp',self.path + feature_fn)
+        self.commit(iloc0,iloc1,features.shape[0])
+
+    def commit(self,iloc0,iloc1,n_rows):
+        with open(self.manifest_path,'a') as f:
+            f.write('%i %i %i\n' %(iloc0,iloc1,n_rows))
+            f.flush()
+            os.fsync(f.fileno())
+        self.shards.append((iloc0,iloc1,n_rows))
+        self.sorted_ids = None
+
+    def open_shards(self):
+        '''
+        returns:
+            list of (row_ids, features) per committed shard, features memory-mapped read-only
+        '''
+        return [self.open_shard(iloc0,iloc1) for iloc0,iloc1,n_rows in self.shards]
+
+    def open_shard(self,iloc0,iloc1):
+        '''
+        open_shard for a committed shard, kept open for later reads
+        '''
+        if (iloc0,iloc1) not in self.opened:
+            self.opened[(iloc0,iloc1)] = open_shard(self.path,iloc0,iloc1)
+        return self.opened[(iloc0,iloc1)]
+
+    def read_rows(self,start,stop):
+        '''
+        rows start:stop of the store in commit order.  If they all sit in one
+        shard the features come back as a memory-mapped view, so nothing is read
+        until it is used; otherwise only those rows are copied.
+        returns:
+            row_ids: (stop-start,)
+            features: (stop-start, d)
+        '''
+        return self.take(np.arange(start,stop))
+
+    def take(self,positions):
+        '''
+        rows at the given positions (in commit order) of the store.  Only the
+        pages holding those rows are read from disk.
+        returns:
+            row_ids: (len(positions),)
+            features: (len(positions), d), a memory-mapped view if positions is
+                a contiguous ascending range inside one shard
+        '''
+        positions = np.asarray(positions,dtype=np.int64)
+        offsets = np.cumsum([0] + [n_rows for iloc0,iloc1,n_rows in self.shards])
+        if len(positions)>0:
+            assert positions.min()>=0 and positions.max()<offsets[-1], \
+                "store has %i rows, asked for row %i" %(offsets[-1],positions.max())
+        shard_of = np.searchsorted(offsets,positions,side='right') - 1
+
+        if len(positions)>0 and shard_of[0]==shard_of[-1] and \
+                np.array_equal(positions,np.arange(positions[0],positions[0]+len(positions))):
+            iloc0,iloc1,n_rows = self.shards[shard_of[0]]
+            row_ids,features = self.open_shard(iloc0,iloc1)
+            lo = positions[0] - offsets[shard_of[0]]
+            return row_ids[lo:lo+len(positions)], features[lo:lo+len(positions)]
+
+        out_row_ids = None
+        out = None
+        for s in np.unique(shard_of):
+            iloc0,iloc1,n_rows = self.shards[s]
+            row_ids,features = self.open_shard(iloc0,iloc1)
+            if out is None:
+                out_row_ids = np.zeros(len(positions),dtype=row_ids.dtype)
+                out = np.zeros((len(positions),features.shape[1]),dtype=features.dtype)
+            mask = shard_of==s
+            local = positions[mask] - offsets[s]
+            out_row_ids[mask] = row_ids[local]
+            out[mask] = features[local]
+        if out is None:
+            width = self.n_features() if self.shards or os.path.exists(self.width_path) else 0
+            return np.zeros(0,dtype=np.int64), np.zeros((0,width),dtype=self.dtype)
+        return out_row_ids, out
+
+    def signature(self):
+        '''
+        sha1 of the manifest and of the name, size and mtime of every committed
+        shard file and of source.json, for cache keys.  Changes whenever a
+        shard is added or rewritten, without reading the features
+        '''
+        h = hashlib.sha1()
+        fns = ['shards.txt','source.json']
+        for iloc0,iloc1,n_rows in self.shards:
+            fns.extend(shard_filenames(iloc0,iloc1))
+        for fn in fns:
+            h.update(fn)
+            if os.path.exists(self.path + fn):
+                st = os.stat(self.path + fn)
+                h.update('%i %r' %(st.st_size,st.st_mtime))
+        with open(self.manifest_path,'rb') as f:
+            h.update(f.read())
+        return h.hexdigest()
+
+    def build_index(self):
+        '''
+        sort the row ids of all shards once, for lookup
+        '''
+        all_ids = np.concatenate([row_ids for row_ids,features in self.open_shards()])
+        order = np.argsort(all_ids,kind='mergesort')
+        self.sorted_ids = all_ids[order]
+        self.sorted_positions = order
+        assert len(self.sorted_ids)<2 or (self.sorted_ids[1:]!=self.sorted_ids[:-1]).all(), \
+            "duplicate row ids in %s" %self.path
+
+    def locate(self,row_ids):
+        '''
+        returns:
+            idx: (len(row_ids),) position of each row id in the sorted ids,
+                meaningful where found
+            found: (len(row_ids),) bool mask, False for rows missing from the store
+        '''
+        if self.sorted_ids is None:
+            self.build_index()
+        row_ids = np.asarray(row_ids)
+        idx = np.searchsorted(self.sorted_ids,row_ids)
+        idx[idx==len(self.sorted_ids)] = 0
+        if len(self.sorted_ids)==0:
+            return idx, np.zeros(len(row_ids),dtype=bool)
+        return idx, self.sorted_ids[idx]==row_ids
+
+    def has_rows(self,row_ids):
+        '''
+        (len(row_ids),) bool mask of the row ids that have features, without
+        reading any features
+        '''
+        if not self.shards:
+            return np.zeros(len(row_ids),dtype=bool)
+        return self.locate(row_ids)[1]
+
+    def lookup(self,row_ids):
+        '''
+        features for the given data frame index values, in that order, whatever
+        order they were extracted in.  O(n log n) via searchsorted on the sorted ids.
+        returns:
+            features: (len(row_ids), d), zero rows where there are no features
+            found: (len(row_ids),) bool mask, False for rows missing from the store
+        '''
+        assert self.shards, "%s is empty" %self.path
+        idx,found = self.locate(row_ids)
+        iloc0,iloc1,n_rows = self.shards[0]
+        first_shard = self.open_shard(iloc0,iloc1)[1]
+        features = np.zeros((len(row_ids),first_shard.shape[1]),dtype=first_shard.dtype)
+        if found.any():
+            features[found] = self.take(self.sorted_positions[idx[found]])[1]
+        return features, found
+
+class StoreRows(object):
+    '''
+    read-only array-like view of rows start:stop of a store, in commit order.
+    Indexing with a slice or an array of positions reads just those rows via
+    FeatureSink.take, so models.iterate_minibatches can run over a store that
+    does not fit in memory.  A store of (n, 1) targets can be viewed as a
+    vector by picking its column
+    '''
+    def __init__(self,sink,start=0,stop=None,column=None):
+        if stop is None:
+            stop = sink.committed_rows
+        assert 0<=start<=stop<=sink.committed_rows
+        self.sink = sink
+        self.start = start
+        self.stop = stop
+        self.column = column
+        if column is None:
+            self.shape = (stop-start,sink.n_features())
+        else:
+            self.shape = (stop-start,)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self,key):
+        if isinstance(key,slice):
+            positions = np.arange(*key.indices(self.shape[0]))
+        else:
+            positions = np.asarray(key,dtype=np.int64)
+            positions = np.where(positions<0,positions+self.shape[0],positions)
+        features = self.sink.take(self.start + np.atleast_1d(positions))[1]
+        if self.column is not None:
+            features = features[:,self.column]
+        if np.ndim(positions)==0:
+            return features[0]
+        return np.array(features)
+
+def shard_filenames(iloc0,iloc1):
+    return 'features_%i_%i.npy' %(iloc0,iloc1), 'row_ids_%i_%i.npy' %(iloc0,iloc1)
+
+def open_shard(path,iloc0,iloc1):
+    feature_fn,row_id_fn = shard_filenames(iloc0,iloc1)
+    return np.load(path + row_id_fn), np.load(path + feature_fn,mmap_mode='r')
+
+def read_manifest(manifest_path):
+    '''
+    committed shards as a list of (iloc0, iloc1, n_rows).  A trailing line
+    without a newline was cut off mid-write and is ignored.
+    '''
+    shards = []
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            for line in f:
+                if line.endswith('\n'):
+                    iloc0,iloc1,n_rows = [int(x) for x in line.split()]
+                    shards.append((iloc0,iloc1,n_rows))
+    return shards
+
+def is_feature_store(path):
+    return os.path.isdir(path) and os.path.exists(os.path.join(path,'shards.txt'))
+
+def source_stat(pkl_path):
+    st = os.stat(pkl_path)
+    return {'source_size':st.st_size,'source_mtime':st.st_mtime}
+
+def is_converted(store_path,pkl_path):
+    '''
+    True if store_path holds a conversion of pkl_path as it is now.  A store
+    whose pickle has been deleted is taken as current
+    '''
+    if not is_feature_store(store_path):
+        return False
+    if not os.path.exists(pkl_path):
+        return True
+    source_path = os.path.join(store_path,'source.json')
+    try:
+        with open(source_path) as f:
+            source = json.load(f)
+    except IOError:
+        #another job moved a stale store aside since the check above
+        return False
+    return source==source_stat(pkl_path)
+
+def pickle_to_feature_store(pkl_path,store_path,dtype=np.float32):
+    '''
+    conversion of a pickled image feature DataFrame (rows 0 to n) to a
+    single-shard feature store, recording the pickle's size and mtime so a
+    rewritten pickle is converted again.  The store is built under a
+    temporary name and renamed into place, as table_store.convert_csv does
+    returns:
+        FeatureSink for store_path
+    '''
+    import cPickle as pkl
+    stat = source_stat(pkl_path)
+    with open(pkl_path,'rb') as f:
+        df = pkl.load(f)
+    tmp = store_path.rstrip('/') + '.tmp%i/' %os.getpid()
+    sink = FeatureSink(tmp,dtype)
+    assert not sink.shards, "%s already has shards" %tmp
+    sink.append(df.index.get_level_values(0).values,df.values,0,df.shape[0])
+    with open(tmp + 'source.json','w') as f:
+        json.dump(stat,f)
+    install_converted(tmp,store_path,pkl_path)
+    return FeatureSink(store_path,dtype)
+
+def install_converted(tmp,store_path,pkl_path):
+    '''
+    rename the converted store tmp to store_path, unless another job has
+    already put a current conversion there, in which case tmp is removed.
+    A stale store is moved aside before it is deleted, never deleted in place
+    '''
+    path = store_path.rstrip('/')
+    while True:
+        if is_converted(store_path,pkl_path):
+            shutil.rmtree(tmp)
+            return
+        try:
+            os.rename(tmp.rstrip('/'),path)
+            return
+        except OSError:
+            pass
+        if is_converted(store_path,pkl_path):
+            continue
+        stale = path + '.stale%i' %os.getpid()
+        try:
+            os.rename(path,stale)
+        except OSError:
+            continue
+        shutil.rmtree(stale)
@@ -13,14 +13,18 @@ import matplotlib.pyplot as plt
 import theano
 import cPickle as pkl
 import download_images_to_directory as dl
+import feature_store
 from datetime import datetime
+import sys
+import time
+import threading
+import Queue
 
 plog("Theano device: %s" %theano.config.device)
 
-#dnn requires GPU
 import lasagne
 from lasagne.layers import InputLayer, DenseLayer, DropoutLayer
-from lasagne.layers.dnn import Conv2DDNNLayer as ConvLayer
+from lasagne.layers import Conv2DLayer
 from lasagne.layers import MaxPool2DLayer as PoolLayer
 from lasagne.layers import LocalResponseNormalization2DLayer as NormLayer
 from lasagne.utils import floatX
@@ -33,17 +37,50 @@ def load_pretrained_model(datadir):
     mean_image = model['mean image']
     return model, mean_image
 
+CONV_BACKENDS = ('dnn','cpu')
+
+def default_conv_backend():
+    '''
+    'dnn' if cuDNN is usable, otherwise 'cpu'
+    '''
+    try:
+        #dnn requires GPU
+        from lasagne.layers import dnn
+        return 'dnn'
+    except ImportError:
+        return 'cpu'
+
+def get_conv_layer(backend):
+    '''
+    conv layer class for the backend.  The VGG weights come from caffe, which
+    does cross-correlation, so the standard layer must not flip the filters
+    (Conv2DDNNLayer already defaults to flip_filters=False).
+    '''
+    assert backend in CONV_BACKENDS
+    if backend=='dnn':
+        from lasagne.layers.dnn import Conv2DDNNLayer
+        return Conv2DDNNLayer
+    def ConvLayer(incoming, num_filters, filter_size, **kwargs):
+        return Conv2DLayer(incoming, num_filters, filter_size, flip_filters=False, **kwargs)
+    return ConvLayer
+
 # ### Define the network
-def build_image_network():
+def build_image_network(pretrained_vgg,backend=None):
     '''
     builds CNN for image feature extraction
     CNN is designed to match the pretrained network from VGG
 
+    args:
+        pretrained_vgg: model dict from load_pretrained_model
+        backend: 'dnn' (cuDNN, GPU only), 'cpu' (standard conv layer) or None to pick
     returns:
         network
     '''
+    if backend is None:
+        backend = default_conv_backend()
+    ConvLayer = get_conv_layer(backend)
 
-    plog("Building lasagne net...")
+    plog("Building lasagne net with %s conv layers..." %backend)
     net = {}
     net['input'] = InputLayer((None, 3, 224, 224))
     net['conv1'] = ConvLayer(net['input'], num_filters=96, filter_size=7, stride=2)
@@ -61,14 +98,31 @@ def build_image_network():
     net['drop7'] = DropoutLayer(net['fc7'], p=0.5)
     net['fc8'] = DenseLayer(net['drop7'], num_units=1000, nonlinearity=lasagne.nonlinearities.softmax)
     output_layer = net['fc8']
-    lasagne.layers.set_all_param_values(output_layer, PRETRAINED_VGG['values'])
+    lasagne.layers.set_all_param_values(output_layer, pretrained_vgg['values'])
     return net
 
 def iterate_minibatches(series, batchsize):
-    for start_idx in range(0, series.shape[0] - batchsize + 1, batchsize):
+    #the last batch may be short, so every row in the range gets features
+    for start_idx in range(0, series.shape[0], batchsize):
         yield series.iloc[start_idx:start_idx + batchsize]
 
-def prep_for_vgg(url,i,dataset,datadir,width=224,filetype="jpg"):
+def get_shard_range(iloc0,iloc1,num_shards,shard_id,batch_size=1):
+    '''
+    split iloc0:iloc1 into num_shards contiguous ranges on batch boundaries,
+    so independent jobs can each extract one of them
+
+    args:
+        shard_id: which range to return, 0 to num_shards-1
+    returns:
+        shard_iloc0, shard_iloc1
+    '''
+    assert 0<=shard_id<num_shards
+    n_batches = int(np.ceil((iloc1-iloc0)/float(batch_size)))
+    first_batch = shard_id*n_batches//num_shards
+    last_batch = (shard_id+1)*n_batches//num_shards
+    return iloc0 + first_batch*batch_size, min(iloc0 + last_batch*batch_size, iloc1)
+
+def prep_for_vgg(url,i,dataset,datadir,width=224,filetype="jpg",image_store=None,mean_image=None):
     '''
     Check to see image file has been downloaded at current size.  If it has not,
     download and resize image. Saves file to datadir/images/[dataset]_[idx]_w[width].[filetype]
@@ -80,10 +134,17 @@ def prep_for_vgg(url,i,dataset,datadir,width=224,filetype="jpg"):
         dataset: string 'train' or 'test' or other identifier
         datadir: data directory
         width: desired width of image. Will be resized to width squared
+        image_store: None or image_store.ImageShard to read the image from instead
+        mean_image: None to use the mean image of the default extractor
     returns:
         rawim: scaled and cropped image
     '''
-    rawim = dl.prep_image(url,i,dataset,datadir,width,filetype)
+    if mean_image is None:
+        mean_image = get_extractor().load().mean_image
+    if image_store is not None:
+        rawim = image_store.get(i)
+    else:
+        rawim = dl.prep_image(url,i,dataset,datadir,width,filetype)
     if rawim is None: #If image fails to download, produce 'image' of NaN's with same shape
         im=floatX(np.tile(0,(1,3,width,width)))
     else:
@@ -93,12 +154,72 @@ def prep_for_vgg(url,i,dataset,datadir,width=224,filetype="jpg"):
         # Convert to BGR
         im = im[::-1, :, :]
 
-        im = im - MEAN_IMAGE
+        im = im - mean_image
         im=floatX(im[np.newaxis])
     return im
 
-#TODO: modify so it adds to a csv instead of saving a pickle
-def batch_extract_features(batch_series,dataset,datadir,width,filetype):
+def compile_feature_function(net,layer='fc7'):
+    '''
+    compile the deterministic forward pass from the input layer to [layer] once,
+    instead of rebuilding the graph with get_output(...).eval() on every batch
+
+    returns:
+        theano function mapping a (batch,3,224,224) float32 array to (batch,4096) features
+    '''
+    plog("Compiling %s feature function..." %layer)
+    output = lasagne.layers.get_output(net[layer], deterministic=True)
+    return theano.function([net['input'].input_var], output)
+
+def allocate_batch_buffers(batch_size,width=224):
+    '''
+    preallocated buffers reused for every batch
+    returns:
+        raw_buffer: (batch_size,width,width,3) uint8 staging area for the images
+        input_buffer: (batch_size,3,width,width) floatX network input
+    '''
+    raw_buffer = np.zeros((batch_size,width,width,3),dtype=np.uint8)
+    input_buffer = np.zeros((batch_size,3,width,width),dtype=theano.config.floatX)
+    return raw_buffer, input_buffer
+
+def prep_batch_for_vgg(rawims,valid,input_buffer,mean_image):
+    '''
+    vectorised version of prep_for_vgg over a whole batch, written in place
+    args:
+        rawims: (n,width,width,3) uint8 images
+        valid: (n,) bool. invalid rows become all-zero images as in prep_for_vgg
+        input_buffer: (batch_size,3,width,width) float array, batch_size>=n
+        mean_image: (3,width,width) mean image of the pretrained model
+    returns:
+        images: view of the first n rows of input_buffer
+    '''
+    n = rawims.shape[0]
+    images = input_buffer[:n]
+    # Shuffle axes to c01 and convert to BGR
+    images[...] = rawims.transpose(0,3,1,2)[:,::-1]
+    images -= mean_image
+    images[~valid] = 0
+    return images
+
+def load_batch_images(batch_series,dataset,datadir,width,filetype,raw_buffer,image_store=None):
+    '''
+    gather the resized images for batch_series into raw_buffer
+    returns:
+        rawims: (n,width,width,3) uint8. A view of image_store if the rows are contiguous there
+        valid: (n,) bool, False where the image could not be downloaded
+    '''
+    if image_store is not None:
+        return image_store.get_batch(batch_series.index)
+    n = batch_series.shape[0]
+    valid = np.zeros(n,dtype=bool)
+    for k,(i,url) in enumerate(batch_series.iteritems()):
+        rawim = dl.prep_image(url,i,dataset,datadir,width,filetype)
+        if rawim is not None:
+            raw_buffer[k] = rawim[:,:,:3]
+            valid[k] = True
+    return raw_buffer[:n], valid
+
+def batch_extract_features(batch_series,dataset,datadir,width,filetype,image_store=None,buffers=None,
+                           extractor=None):
     '''
     take batch_series and return dataframe of image features with shape (batch_series.shape[0],4096)
     args:
@@ -107,87 +228,292 @@ def batch_extract_features(batch_series,dataset,datadir,width,filetype):
         datadir
         width:224
         filetype:jpg
+        image_store: None or image_store.ImageShard to read images from
+        buffers: None or (raw_buffer,input_buffer) from allocate_batch_buffers,
+            at least batch_series.shape[0] rows long
+        extractor: None for the default VGGFeatureExtractor
     returns:
         featureDF: keeps original indexes, but has different column for each image feature
     '''
-    image_urls = batch_series
+    if extractor is None:
+        extractor = get_extractor()
+    extractor.load()
+    if buffers is None:
+        buffers = allocate_batch_buffers(batch_series.shape[0],width)
+    raw_buffer,input_buffer = buffers
     indexes = batch_series.index
-    first=True
-    for i,url in image_urls.iteritems():
-        im = prep_for_vgg(url,i,dataset,datadir,width,filetype)
-        if first==True:
-            images = im
-            first=False
-        else:
-            images = np.vstack((images,im))
-    
-    #get last layer from vgg model.  This part takes ~1-4 seconds
-    image_features = np.array(lasagne.layers.get_output(IMAGE_NET['fc7'], images, deterministic=True).eval())
+    rawims,valid = load_batch_images(batch_series,dataset,datadir,width,filetype,raw_buffer,image_store)
+    images = prep_batch_for_vgg(rawims,valid,input_buffer,extractor.mean_image)
+    return extract_features(images,indexes,extractor)
+
+def extract_features(images,indexes,extractor=None):
+    '''
+    run a prepared input batch through the network
+    args:
+        extractor: None for the default VGGFeatureExtractor
+    returns:
+        featureDF: fc7 features, one row per image, indexed by indexes
+    '''
+    if extractor is None:
+        extractor = get_extractor()
+    #get last layer from vgg model
+    image_features = extractor.load().feature_fn(images)
 
     featureDF = pd.DataFrame(image_features, index=[indexes]) 
     return featureDF
 
+class BatchPrefetcher(object):
+    '''
+    prepares input batches on background threads while the network runs on the
+    current one.  Iterating yields (batch_series, images) in the original order;
+    images is only valid until the next batch is requested, since its buffer
+    is then recycled.  An exception in a worker is re-raised in the consumer.
+
+    usage:
+        with BatchPrefetcher(batches,...) as prefetcher:
+            for batch_series,images in prefetcher:
+                ...
+    '''
+    def __init__(self,batches,dataset,datadir,batch_size,width=224,filetype='jpg',
+                 image_store=None,queue_depth=2,num_threads=1,extractor=None):
+        '''
+        args:
+            batches: iterable of url series, e.g. iterate_minibatches(image_urls,batch_size)
+            queue_depth: number of prepared batches allowed to wait for the network
+            num_threads: number of threads loading and preparing batches
+            extractor: None for the default VGGFeatureExtractor
+        '''
+        if extractor is None:
+            extractor = get_extractor()
+        self.mean_image = extractor.load().mean_image
+        self.dataset = dataset
+        self.datadir = datadir
+        self.width = width
+        self.filetype = filetype
+        self.image_store = image_store
+        self.wait_times = []
+
+        self.batches = enumerate(batches)
+        self.batches_lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.results = Queue.Queue()
+        #one buffer per waiting batch plus the one the network is using
+        self.free_buffers = Queue.Queue()
+        for b in range(queue_depth+1):
+            self.free_buffers.put(allocate_batch_buffers(batch_size,width))
+        self.threads = []
+        for t in range(num_threads):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def _work(self):
+        while not self.stop_event.is_set():
+            #take a buffer before a batch, so every batch handed out can be finished
+            try:
+                buffers = self.free_buffers.get(timeout=0.1)
+            except Queue.Empty:
+                continue
+            try:
+                with self.batches_lock:
+                    seq,batch_series = next(self.batches)
+            except StopIteration:
+                self.free_buffers.put(buffers)
+                self.results.put(('done',None,None))
+                return
+            except Exception:
+                self.results.put(('error',None,sys.exc_info()))
+                return
+            try:
+                raw_buffer,input_buffer = buffers
+                rawims,valid = load_batch_images(batch_series,self.dataset,self.datadir,self.width,
+                                                 self.filetype,raw_buffer,self.image_store)
+                images = prep_batch_for_vgg(rawims,valid,input_buffer,self.mean_image)
+                self.results.put(('batch',seq,(batch_series,images,buffers)))
+            except Exception:
+                self.results.put(('error',seq,sys.exc_info()))
+                return
+
+    def __iter__(self):
+        pending = {}
+        next_seq = 0
+        done_threads = 0
+        in_use = None
+        try:
+            while True:
+                if in_use is not None:
+                    self.free_buffers.put(in_use)
+                    in_use = None
+                t0 = time.time()
+                while next_seq not in pending:
+                    if done_threads==len(self.threads):
+                        return
+                    kind,seq,value = self.results.get()
+                    if kind=='error':
+                        raise value[0], value[1], value[2]
+                    elif kind=='done':
+                        done_threads += 1
+                    else:
+                        pending[seq] = value
+                self.wait_times.append(time.time()-t0)
+                batch_series,images,in_use = pending.pop(next_seq)
+                next_seq += 1
+                yield batch_series,images
+        finally:
+            self.close()
+
+    def close(self):
+        self.stop_event.set()
+        for thread in self.threads:
+            thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*exc_info):
+        self.close()
+
 def get_selected_image_features(df,
                                 datadir,
                                 dataset,
                                 iloc0,
                                 iloc1,
                                 save_freq,
-                                out_pickle_name='image_features.pkl',
+                                out_pickle_name='image_features',
                                 batch_size=256,
                                 width=224,
-                                filetype='jpg'):
+                                filetype='jpg',
+                                image_store=None,
+                                prefetch_depth=2,
+                                prefetch_threads=1,
+                                extractor=None,
+                                feature_dtype=np.float32):
     '''
     for a given index range, download and resize the images,
-    then save to directory
+    extract their features and append them to the feature store
+    datadir/[out_pickle_name]/ (see feature_store.py)
+
+    Every save commits a checkpoint. If the store already holds rows of this
+    range, extraction resumes after the last committed one.
 
     args:
         df: dataframe where image urls are
         iloc0: int or None. first iloc of range of images to download
         iloc1: int or None. last iloc of range of images to download
-        save_freq: how many batches before saving
-        out_pickle_name: name of outfile
+        save_freq: how many batches between saves (checkpoints)
+        out_pickle_name: name of the feature store directory, relative to datadir
         batch_size: rows per batch
         dataset: string 'train' or 'test' or other identifier
+        image_store: None or image_store.ImageShard holding the images, read
+            in place of the jpegs in datadir/images
+        prefetch_depth: number of batches prepared ahead of the network
+        prefetch_threads: number of threads preparing batches
+        extractor: None for the default VGGFeatureExtractor
+        feature_dtype: np.float32 or np.float16 for the stored features
 
     returns:
         none
     '''
     plog("Beginning feature extraction...")
+    if iloc0 is None:
+        iloc0 = 0
+    if iloc1 is None:
+        iloc1 = df.shape[0]
     assert iloc0<=df.shape[0]
     assert iloc1<=df.shape[0]
+    sink = feature_store.FeatureSink(datadir + out_pickle_name,feature_dtype)
+    if sink.last_iloc is not None:
+        assert sink.last_iloc>=iloc0, "feature store ends at iloc %i, before iloc0 %i" %(sink.last_iloc,iloc0)
+        if sink.last_iloc>=iloc1:
+            plog("Features for iloc %i to %i already extracted" %(iloc0,iloc1))
+            return
+        plog("Resuming from iloc %i, %i rows already committed" %(sink.last_iloc,sink.committed_rows))
+        iloc0 = sink.last_iloc
     image_urls = df.large_image_URL.iloc[iloc0:iloc1]
     iloc=iloc0
     prev_iloc = iloc0
     batch_num=0
-    featureDF = pd.DataFrame()
-    
-    for batch in iterate_minibatches(image_urls,batch_size):
-        plog("extracting image features for batch %i, iloc %i" %(batch_num,iloc))
-        batch_featureDF = batch_extract_features(batch,dataset,datadir,width,filetype)
-        featureDF=featureDF.append(batch_featureDF,verify_integrity=True)
+    row_ids = []
+    features = []
+    compute_times = []
+    if extractor is None:
+        extractor = get_extractor()
+    with BatchPrefetcher(iterate_minibatches(image_urls,batch_size),dataset,datadir,
+                         batch_size,width,filetype,image_store,prefetch_depth,prefetch_threads,
+                         extractor) as prefetcher:
+        for batch,images in prefetcher:
+            plog("extracting image features for batch %i, iloc %i" %(batch_num,iloc))
+            t0 = time.time()
+            batch_featureDF = extract_features(images,batch.index,extractor)
+            compute_times.append(time.time()-t0)
+            plog("batch %i: %.2fs waiting for input, %.2fs in forward pass" %(
+                batch_num,prefetcher.wait_times[-1],compute_times[-1]))
+            row_ids.append(batch.index.values)
+            features.append(batch_featureDF.values)
         
-        iloc+=batch_size
-        batch_num+=1
+            iloc+=batch.shape[0]
+            batch_num+=1
         
-        if iloc>iloc0 and (batch_num%save_freq==0 or iloc>=iloc1-1):
-            plog("Saving from image iloc %i to image iloc %i" %(prev_iloc,iloc))
-            #Append to csv here
-            with open('csv_fn.csv','a') as outf:
-                featureDF.to_csv(outf,header=False)
+            if iloc>iloc0 and (batch_num%save_freq==0 or iloc>=iloc1):
+                plog("Saving from image iloc %i to image iloc %i" %(prev_iloc,iloc))
+                sink.append(np.concatenate(row_ids),np.vstack(features),prev_iloc,iloc)
+                prev_iloc = iloc
 
-            #with open(datadir+out_pickle_name + '_' + str(prev_iloc) + '_' + str(iloc)+'.pkl','wb') as outf:
-            #    pkl.dump(featureDF,outf)  
-            prev_iloc = iloc
+                #reset to save memory
+                row_ids = []
+                features = []
 
-            #reset featureDF to save memory
-            featureDF = pd.DataFrame()
+    if batch_num>0:
+        plog("total %.1fs waiting for input, %.1fs in forward pass over %i batches" %(
+            sum(prefetcher.wait_times),sum(compute_times),batch_num))
 
 
 
 DATADIR = "../data/"
-PRETRAINED_VGG, MEAN_IMAGE = load_pretrained_model(DATADIR)
-IMAGE_NET = build_image_network()
+
+class VGGFeatureExtractor(object):
+    '''
+    pretrained VGG-CNN-S network and its compiled feature function.
+    Nothing is read or built until load() is called, so importing this module
+    stays cheap for scripts that never extract features.
+    '''
+    def __init__(self,datadir=DATADIR,backend=None,layer='fc7'):
+        self.datadir = datadir
+        self.backend = backend
+        self.layer = layer
+        self.model = None
+        self.mean_image = None
+        self.net = None
+        self.feature_fn = None
+        self.lock = threading.Lock()
+
+    @property
+    def loaded(self):
+        return self.feature_fn is not None
+
+    def load(self):
+        '''
+        load the weights, build the network and compile the feature function,
+        once.  returns self
+        '''
+        with self.lock:
+            if not self.loaded:
+                self.model, self.mean_image = load_pretrained_model(self.datadir)
+                self.net = build_image_network(self.model,self.backend)
+                self.feature_fn = compile_feature_function(self.net,self.layer)
+        return self
+
+EXTRACTORS = {}
+
+def get_extractor(datadir=DATADIR,backend=None,layer='fc7'):
+    '''
+    cached VGGFeatureExtractor for these settings. It is not loaded yet
+    '''
+    key = (datadir,backend,layer)
+    if key not in EXTRACTORS:
+        EXTRACTORS[key] = VGGFeatureExtractor(datadir,backend,layer)
+    return EXTRACTORS[key]
 
 if __name__ == '__main__':
     from datetime import datetime
@@ -0,0 +1,106 @@
+'''
+image_store.py
+
+Packed image shards: instead of one jpeg per product, the resized images for a
+range of rows are kept in one uint8 array of shape (N, width, width, 3).
+Each shard is a directory holding
+    images.npy:  (N, width, width, 3) uint8, memory-mapped
+    row_ids.npy: (N,) data frame index of each image, i.e. row id -> offset
+    valid.npy:   (N,) bool, False where the download failed or has not run yet
+'''
+
+import os
+import numpy as np
+
+def shard_path(datadir,dataset,width,first_idx,last_idx):
+    '''
+    directory of the shard holding rows first_idx to last_idx, e.g.
+    datadir/image_shards/train_w224_0_10000/
+    '''
+    return datadir + 'image_shards/%s_w%i_%s_%s/' %(dataset,width,first_idx,last_idx)
+
+class ImageShard(object):
+    '''
+    memory-mapped shard of images.  Open an existing shard with ImageShard(path),
+    or make a new one with ImageShard.create(path,row_ids,width).
+    '''
+    def __init__(self,path,mode='r'):
+        self.path = path
+        self.images = np.load(path+'images.npy',mmap_mode=mode)
+        self.valid = np.load(path+'valid.npy',mmap_mode=mode)
+        self.row_ids = np.load(path+'row_ids.npy')
+        self.width = self.images.shape[1]
+        self.offsets = dict((row_id,i) for i,row_id in enumerate(self.row_ids))
+
+    @classmethod
+    def create(cls,path,row_ids,width):
+        '''
+        create an empty writable shard for row_ids.  If the shard already exists
+        it is reopened for writing, so an interrupted download can resume.
+
+        args:
+            path: shard directory
+            row_ids: data frame index values of the images, in storage order
+            width: width of the square images
+        returns:
+            ImageShard opened in 'r+' mode
+        '''
+        row_ids = np.asarray(row_ids)
+        if os.path.exists(path+'valid.npy'):
+            shard = cls(path,'r+')
+            assert np.array_equal(shard.row_ids,row_ids)
+            assert shard.width==width
+            return shard
+
+        if not os.path.exists(path):
+            os.makedirs(path)
+        np.save(path+'row_ids.npy',row_ids)
+        images = np.lib.format.open_memmap(path+'images.npy',mode='w+',dtype=np.uint8,
+                                           shape=(len(row_ids),width,width,3))
+        del images
+        #valid.npy is written last; its presence marks a complete shard layout
+        np.save(path+'valid.npy',np.zeros(len(row_ids),dtype=bool))
+        return cls(path,'r+')
+
+    def __len__(self):
+        return len(self.row_ids)
+
+    def __contains__(self,row_id):
+        '''
+        True if the image for row_id has been stored successfully
+        '''
+        i = self.offsets.get(row_id)
+        return i is not None and bool(self.valid[i])
+
+    def write(self,row_id,rawim):
+        self.images[self.offsets[row_id]] = rawim
+        self.valid[self.offsets[row_id]] = True
+
+    def get(self,row_id):
+        '''
+        returns a read-only view of the stored image, or None if it is not valid
+        '''
+        i = self.offsets[row_id]
+        if not self.valid[i]:
+            return None
+        return self.images[i]
+
+    def get_batch(self,row_ids):
+        '''
+        images and validity flags for a batch of row ids.  Rows stored
+        contiguously come back as views of the memory map, without a copy.
+
+        returns:
+            images: (len(row_ids), width, width, 3) uint8
+            valid: (len(row_ids),) bool
+        '''
+        offsets = np.array([self.offsets[row_id] for row_id in row_ids],dtype=np.int64)
+        if len(offsets)>0 and np.array_equal(offsets,np.arange(offsets[0],offsets[0]+len(offsets))):
+            batch = slice(offsets[0],offsets[0]+len(offsets))
+        else:
+            batch = offsets
+        return self.images[batch], np.asarray(self.valid[batch])
+
+    def flush(self):
+        self.images.flush()
+        self.valid.flush()
@@ -10,7 +10,7 @@ import sys
 
 #Command-line arguments
 if len(sys.argv)<2:
-    plog("Usage: python main.py [num_train_samples] [use_images|use_text]")
+    plog("Usage: python main.py [num_train_samples] [use_images|use_text] [chunked]")
     sys.exit()
 else:
     train_samples = int(sys.argv[1])
@@ -22,9 +22,12 @@ else:
         use_text=True
     else:
         use_text=False
+    #chunked: prepare the full catalogue out of core, ignoring num_train_samples
+    chunked = 'chunked' in sys.argv
 
 plog('importing main.py modules...')
 import os
+import multiprocessing
 import data_prep
 import models
 import pdb
@@ -42,6 +45,11 @@ options_dict = {
     'train_image_fn': 'train_image_features_0_100000.pkl',
     'test_image_fn': 'test_image_features_0_100000.pkl',
     'debug': False,
+    'sparse': True, # keep brand and bag-of-words features sparse until each minibatch; X is dense with images
+    'chunked': chunked, # stream the full catalogue into feature stores instead
+    'hash_buckets': None, # e.g. 2**14 to hash text instead of using tokenizer_5000.pkl
+    'num_processes': multiprocessing.cpu_count(), # bag of words worker processes
+    'drop_missing_images': True, # with use_images, leave out rows that have no image features
 
     #MODEL PARAMS,
     'num_epochs': 200, #200
@@ -82,7 +90,17 @@ print train_samples
 test_samples = int(0.1*train_samples)
 
 plog("Starting data_prep with %s training samples; use_images=%s; use_text=%s" %(train_samples,use_images,use_text))
-data,n_values = data_prep.main(datadir,
+if chunked:
+    data,n_values = data_prep.main_chunked(datadir,
+                                val_portion,
+                                use_images,
+                                use_text,
+                                train_image_fn,
+                                test_image_fn,
+                                hash_buckets=hash_buckets,
+                                drop_missing_images=drop_missing_images)
+else:
+    data,n_values = data_prep.main(datadir,
                                 train_samples,
                                 test_samples,
                                 val_portion,
@@ -90,7 +108,11 @@ data,n_values = data_prep.main(datadir,
                                 use_text,
                                 train_image_fn,
                                 test_image_fn,
-                                debug)
+                                debug,
+                                sparse,
+                                hash_buckets=hash_buckets,
+                                num_processes=num_processes,
+                                drop_missing_images=drop_missing_images)
 
 plog("Starting model...")
 
@@ -2,11 +2,15 @@ import cPickle as pkl
 import os
 import sys
 import time
+import multiprocessing
 
 from subprocess import Popen, PIPE
 
 #from sklearn.feature_extraction.text import CountVectorizer
 import pandas as pd
+import table_store
+import moses_tokenizer
+import vocab
 import numpy
 #from scipy.sparse import hstack, lil_matrix
 
@@ -14,25 +18,27 @@ import pdb
 
 # tokenizer.perl is from Moses: https://github.com/moses-smt/mosesdecoder/tree/master/scripts/tokenizer
 tokenizer_cmd = ['./mosesdecoder/scripts/tokenizer/tokenizer.perl', '-l', 'en', '-q', '-']
+#set to tokenizer_cmd to tokenize with tokenizer.perl itself, run as parallel workers
+moses_cmd = None
+#tokenized chunks are cached here, so reruns do not tokenize the same descriptions again
+token_cache_dir = os.path.join(os.path.dirname(__file__),'..','data','token_cache')
 
 
 def tokenize(sentences):
     """
     Tokenizes sentences by removing irrelevant punctuation, etc.
-    Uses the mosesdecoder in some way.
+    Uses the in-process port of the Moses tokenizer rules, or tokenizer.perl if
+    moses_cmd is set, one output per sentence.
 
     Args:
         sentences: list of sentences
 
     Returns:
-        toks: list of tokens?
+        toks: list of tokenized sentences, aligned with sentences
     """
 
     print 'Tokenizing..',
-    text = "\n".join(sentences)
-    tokenizer = Popen(tokenizer_cmd, stdin=PIPE, stdout=PIPE)
-    tok_text, _ = tokenizer.communicate(text)
-    toks = tok_text.split('\n')[:-1]
+    toks = moses_tokenizer.tokenize_corpus(sentences,moses_cmd,multiprocessing.cpu_count(),cache_dir=token_cache_dir)
     print 'Done'
 
     return toks
@@ -51,7 +57,7 @@ def build_dict(path):
         cat_1_dict: dict of category with counts for each
         cat_2_dict: dict of category with counts for each
     """
-    train_df = pd.read_csv(path,header = 0, index_col = 0,low_memory = False)
+    train_df = table_store.read_csv_columns(path,['description_clean'])
 
     descriptions = list(train_df.description_clean.astype(str))
 
@@ -60,29 +66,12 @@ def build_dict(path):
     print "Done"
 
     print 'Getting descriptions word count..',
-    wordcount = dict()
-    for ss in descriptions:
-        words = ss.strip().lower().split()
-        
-        for w in words:
-            if w not in wordcount:
-                wordcount[w] = 1
-            else:
-                wordcount[w] += 1
+    wordcount = vocab.count_texts(descriptions,num_processes=multiprocessing.cpu_count())
     print 'Done'
 
-    counts = wordcount.values()
-    keys = wordcount.keys()
-    sorted_idx = numpy.argsort(counts)[::-1]
-
-    worddict = dict()
-
-    idx = 0
-    for ss in sorted_idx:
-    	worddict[keys[ss]] = idx + 2 #leave 0 and 1, and cat_1's + cat_2's
-    	idx += 1
+    worddict = wordcount.word_index(start=2) #leave 0 and 1
         
-    print numpy.sum(counts), ' total words ', len(keys), ' unique words'
+    print sum(wordcount.counts.itervalues()), ' total words ', len(wordcount), ' unique words'
 
     return worddict
 
@@ -90,7 +79,7 @@ def build_dict(path):
 def grab_bag_of_words(path, dictionary):
 	
     print 'loading data...'
-    data = pd.read_csv(path,index_col = 0, header = 0,low_memory=False)
+    data = table_store.read_csv_columns(path,['description_clean','brand_num','cat_1_num','cat_2_num','cat_3_num'])
 
     sentences = list(data.description_clean.astype(str))
     brands = list(data.brand_num.astype(int))
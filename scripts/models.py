@@ -13,6 +13,7 @@ import cPickle
 import collections
 
 import numpy as np
+import scipy.sparse
 import theano
 import theano.tensor as T
 import lasagne
@@ -75,16 +76,20 @@ def iterate_minibatches(data, batchsize, shuffle=False):
     inputs = data[0]
     targets = data[1:4]
 
-    assert len(inputs) == len(targets[0])
+    assert inputs.shape[0] == len(targets[0])
     if shuffle:
-        indices = np.arange(len(inputs))
+        indices = np.arange(inputs.shape[0])
         np.random.shuffle(indices)
-    for start_idx in range(0, len(inputs) - batchsize + 1, batchsize):
+    for start_idx in range(0, inputs.shape[0] - batchsize + 1, batchsize):
         if shuffle:
             excerpt = indices[start_idx:start_idx + batchsize]
         else:
             excerpt = slice(start_idx, start_idx + batchsize)
-        yield inputs[excerpt], [y[excerpt] for y in targets]
+        batch = inputs[excerpt]
+        if scipy.sparse.issparse(batch):
+            #sparse inputs are only densified one minibatch at a time
+            batch = batch.toarray()
+        yield batch, [y[excerpt] for y in targets]
 
 def get_all_params(network):
     params = []
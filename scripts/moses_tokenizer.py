@@ -0,0 +1,253 @@
+'''
+moses_tokenizer.py
+
+In-process port of the English rules of the Moses tokenizer
+(mosesdecoder/scripts/tokenizer/tokenizer.perl -l en -q), so descriptions can
+be tokenised without a perl subprocess.  Each sentence is tokenised on its
+own, so there is always exactly one output per input, even for sentences
+with embedded newlines, and chunks of sentences can be tokenised in parallel.
+tokenize_corpus can also drive tokenizer.perl itself, and caches tokenized
+chunks on disk.
+As in tokenizer.perl the output is escaped (&amp; &#124; &lt; &gt; &apos;
+&quot; &#91; &#93;).  benchmarks.py check_moses checks the rules against a
+fixture corpus, and against tokenizer.perl when it is there.
+'''
+
+import os
+import re
+import hashlib
+import functools
+import itertools
+import threading
+import subprocess
+import multiprocessing
+import multiprocessing.pool
+
+#bump when the rules change, so cached chunks are tokenized again
+RULES_VERSION = 2
+
+#nonbreaking_prefix.en: a period after these is not a sentence end.
+#2 means only when the next word is a number
+NONBREAKING_PREFIXES = dict((p,1) for p in
+    [chr(c) for c in range(ord('A'),ord('Z')+1)] +
+    '''Adj Adm Adv Asst Bart Bldg Brig Bros Capt Cmdr Col Comdr Con Corp Cpl DR Dr Drs
+    Ens Gen Gov Hon Hr Hosp Insp Lt MM MR MRS MS Maj Messrs Mlle Mme Mr Mrs Ms Msgr Op
+    Ord Pfc Ph Prof Pvt Rep Reps Res Rev Rt Sen Sens Sfc Sgt Sr St Supt Surg
+    v vs i.e rev e.g Nos Nr Jan Feb Mar Apr Jun Jul Aug Sep Sept Oct Nov Dec'''.split())
+NONBREAKING_PREFIXES.update((p,2) for p in ['No','Art','pp'])
+
+#perl's \p{IsAlpha} and \p{IsAlnum}, approximately, for unicode text
+ALPHA = r"[^\W\d_]"
+NON_ALPHA = r"[\W\d_]"
+
+SPECIAL = re.compile(r"([^\w\s.'`,\-]|_)",re.UNICODE)
+CONTRACTIONS = [
+    (re.compile(r"(%s)'(%s)" %(NON_ALPHA,NON_ALPHA),re.UNICODE), r"\1 ' \2"),
+    (re.compile(r"([\W_])'(%s)" %ALPHA,re.UNICODE), r"\1 ' \2"),
+    (re.compile(r"(%s)'(%s)" %(ALPHA,NON_ALPHA),re.UNICODE), r"\1 ' \2"),
+    (re.compile(r"(%s)'(%s)" %(ALPHA,ALPHA),re.UNICODE), r"\1 '\2"),
+    (re.compile(r"(\d)'(s)",re.UNICODE), r"\1 '\2"),
+]
+ESCAPES = [('&','&amp;'),('|','&#124;'),('<','&lt;'),('>','&gt;'),
+           ("'",'&apos;'),('"','&quot;'),('[','&#91;'),(']','&#93;')]
+
+def tokenize_unicode(text):
+    '''
+    tokenizer.perl's tokenize() on one unicode sentence
+    '''
+    #padded as in tokenizer.perl, so the apostrophe rules see a space at
+    #either end; the padding is stripped after the word loop
+    text = u' ' + text + u' '
+    text = re.sub(r'\s+',u' ',text,flags=re.UNICODE)
+    text = re.sub(u'[\x00-\x1f]',u'',text)
+    text = SPECIAL.sub(r' \1 ',text)
+
+    #multi-dots stay together
+    text = re.sub(r'\.(\.+)',r' DOTMULTI\1',text)
+    while u'DOTMULTI.' in text:
+        text = re.sub(r'DOTMULTI\.([^.])',r'DOTDOTMULTI \1',text)
+        text = text.replace(u'DOTMULTI.',u'DOTDOTMULTI')
+
+    #separate out "," except if within numbers (5,300)
+    text = re.sub(r'(\D),',r'\1 , ',text,flags=re.UNICODE)
+    text = re.sub(r',(\D)',r' , \1',text,flags=re.UNICODE)
+    text = re.sub(r'(\d),$',r'\1 , ',text,flags=re.UNICODE)
+
+    for pattern,repl in CONTRACTIONS:
+        text = pattern.sub(repl,text)
+
+    #a period ends a word unless the word is an abbreviation
+    words = text.split(u' ')
+    for i,word in enumerate(words):
+        if len(word)>1 and word.endswith(u'.'):
+            pre = word[:-1]
+            next_word = words[i+1] if i<len(words)-1 else u''
+            prefix = NONBREAKING_PREFIXES.get(pre)
+            if (u'.' in pre and re.search(ALPHA,pre,re.UNICODE)) or prefix==1 or next_word[:1].islower():
+                pass
+            elif prefix==2 and next_word[:1].isdigit():
+                pass
+            else:
+                words[i] = pre + u' .'
+    text = re.sub(u' +',u' ',u' '.join(words)).strip(u' ')
+    text = re.sub(r"\.' ?$",u" . ' ",text,count=1)
+
+    while u'DOTDOTMULTI' in text:
+        text = text.replace(u'DOTDOTMULTI',u'DOTMULTI.')
+    text = text.replace(u'DOTMULTI',u'.')
+
+    for char,escaped in ESCAPES:
+        text = text.replace(char,escaped)
+    return text
+
+def escape_newlines(sentence):
+    '''
+    sentence on one line.  Both tokenizers turn any run of whitespace into one
+    space, so this does not change the tokens
+    '''
+    return sentence.replace('\n',' ').replace('\r',' ')
+
+def tokenize(sentence):
+    '''
+    tokenised form of one utf-8 (or unicode) sentence, of the same type, on
+    one line.  Blank sentences come back with their newlines escaped but
+    otherwise unchanged, as tokenizer.perl passes blank lines through
+    '''
+    sentence = escape_newlines(sentence)
+    if not sentence.strip():
+        return sentence
+    if isinstance(sentence,unicode):
+        return tokenize_unicode(sentence)
+    try:
+        text = sentence.decode('utf-8')
+    except UnicodeDecodeError:
+        text = sentence.decode('utf-8','replace')
+    return tokenize_unicode(text).encode('utf-8')
+
+def _tokenize_chunk(sentences):
+    return [tokenize(s) for s in sentences]
+
+def run_perl(perl_cmd,sentences):
+    '''
+    tokenize sentences with one tokenizer.perl process, writing input from a
+    thread while output is read line by line, so neither side is buffered whole
+    returns:
+        one tokenized sentence per input
+    '''
+    #close_fds so that concurrent workers do not hold each other's stdin open
+    proc = subprocess.Popen(perl_cmd,stdin=subprocess.PIPE,stdout=subprocess.PIPE,close_fds=True)
+    def feed():
+        try:
+            for sentence in sentences:
+                proc.stdin.write(escape_newlines(sentence) + '\n')
+        except IOError:
+            #the process died; the line count check below reports it
+            pass
+        finally:
+            proc.stdin.close()
+    writer = threading.Thread(target=feed)
+    writer.daemon = True
+    writer.start()
+    toks = [line[:-1] if line.endswith('\n') else line for line in iter(proc.stdout.readline,'')]
+    writer.join()
+    proc.wait()
+    assert proc.returncode==0, "%s exited with %i" %(' '.join(perl_cmd),proc.returncode)
+    assert len(toks)==len(sentences), "%s gave %i lines for %i sentences" %(' '.join(perl_cmd),len(toks),len(sentences))
+    return toks
+
+def perl_backend(perl_cmd):
+    '''
+    cache identity for a tokenizer.perl command line: the command, and a hash
+    of the contents of the script, its nonbreaking prefix file and any other
+    files named on the command line, so editing them invalidates the cache
+    '''
+    scripts = [arg for arg in perl_cmd if arg.endswith(('.perl','.pl'))] or perl_cmd[:1]
+    lang = perl_cmd[perl_cmd.index('-l')+1] if '-l' in perl_cmd[:-1] else 'en'
+    prefixes = os.path.join(os.path.dirname(scripts[0]),'..','share','nonbreaking_prefixes',
+                            'nonbreaking_prefix.' + lang)
+    h = hashlib.sha1()
+    for path in scripts + [prefixes] + [arg for arg in perl_cmd if arg not in scripts]:
+        if os.path.isfile(path):
+            h.update(path + '\n')
+            with open(path,'rb') as f:
+                h.update(f.read())
+    return 'perl %s %s' %(' '.join(perl_cmd),h.hexdigest())
+
+def chunk_key(backend,sentences):
+    h = hashlib.sha1(backend)
+    for sentence in sentences:
+        h.update(sentence.encode('utf-8') if isinstance(sentence,unicode) else sentence)
+        h.update('\n')
+    return h.hexdigest()
+
+def read_cached(path,n):
+    '''
+    cached tokenized chunk of n sentences, or None if missing or not n lines
+    '''
+    if not os.path.exists(path):
+        return None
+    with open(path,'rb') as f:
+        toks = f.read().split('\n')[:-1]
+    return toks if len(toks)==n else None
+
+def write_cached(path,toks):
+    tmp = path + '.tmp%i' %os.getpid()
+    with open(tmp,'wb') as f:
+        for tok in toks:
+            f.write((tok.encode('utf-8') if isinstance(tok,unicode) else tok) + '\n')
+    os.rename(tmp,path)
+
+def tokenize_corpus(sentences,perl_cmd=None,num_processes=1,chunk_size=10000,cache_dir=None):
+    '''
+    tokenize sentences in chunks of chunk_size, num_processes chunks at a time.
+    Returns one tokenized sentence per input, in order.
+
+    args:
+        perl_cmd: tokenizer.perl command line to run as num_processes concurrent
+            processes, for output exactly as Moses gives it, or None to use the
+            in-process rules across num_processes worker processes
+        cache_dir: if given, each tokenized chunk is kept there under a hash of
+            the backend and the chunk's sentences, and chunks found there are
+            not tokenized again.  For perl_cmd the backend includes the
+            contents of the script and its prefix file (see perl_backend).  Cached chunks come back as utf-8 str
+    '''
+    sentences = list(sentences)
+    chunks = [sentences[start:start+chunk_size] for start in range(0,len(sentences),chunk_size)]
+    backend = perl_backend(perl_cmd) if perl_cmd else 'python %i' %RULES_VERSION
+    results = [None]*len(chunks)
+    paths = [None]*len(chunks)
+    if cache_dir is not None:
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        for i,chunk in enumerate(chunks):
+            paths[i] = os.path.join(cache_dir,chunk_key(backend,chunk) + '.txt')
+            results[i] = read_cached(paths[i],len(chunk))
+    missing = [i for i,toks in enumerate(results) if toks is None]
+
+    pool = None
+    if perl_cmd:
+        pool = multiprocessing.pool.ThreadPool(num_processes)
+        tokenized = pool.imap(functools.partial(run_perl,perl_cmd),[chunks[i] for i in missing])
+    elif num_processes>1 and len(missing)>1:
+        pool = multiprocessing.Pool(num_processes)
+        tokenized = pool.imap(_tokenize_chunk,[chunks[i] for i in missing])
+    else:
+        tokenized = itertools.imap(_tokenize_chunk,[chunks[i] for i in missing])
+    try:
+        for i,toks in itertools.izip(missing,tokenized):
+            results[i] = toks
+            if paths[i] is not None:
+                write_cached(paths[i],toks)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return [tok for toks in results for tok in toks]
+
+def tokenize_sentences(sentences,num_processes=1,chunk_size=10000):
+    '''
+    tokenize each sentence in-process, in chunks of chunk_size across
+    num_processes worker processes if more than one.  Returns one tokenised
+    sentence per input, in order
+    '''
+    return tokenize_corpus(sentences,None,num_processes,chunk_size)
@@ -1,8 +1,9 @@
 """
 This script is what created the dataset pickled.
 
-1) You need to download this file and put it in the same directory as this file.
-https://github.com/moses-smt/mosesdecoder/raw/master/scripts/tokenizer/tokenizer.perl . Give it execution permission.
+1) Descriptions are tokenized in-process by moses_tokenizer, which follows
+https://github.com/moses-smt/mosesdecoder/raw/master/scripts/tokenizer/tokenizer.perl .
+Set moses_cmd = tokenizer_cmd to run tokenizer.perl itself instead.
 
 2) Get the dataset from  and extract it in the current directory.
 
@@ -17,29 +18,33 @@ from collections import OrderedDict
 
 import glob
 import os
+import multiprocessing
 
 from subprocess import Popen, PIPE
 
 import pandas as pd
+import table_store
+import moses_tokenizer
 
 # tokenizer.perl is from Moses: https://github.com/moses-smt/mosesdecoder/tree/master/scripts/tokenizer
 tokenizer_cmd = ['./mosesdecoder/scripts/tokenizer/tokenizer.perl', '-l', 'en', '-q', '-']
+#set to tokenizer_cmd to tokenize with tokenizer.perl itself, run as parallel workers
+moses_cmd = None
+#tokenized chunks are cached here, so reruns do not tokenize the same descriptions again
+token_cache_dir = os.path.join(os.path.dirname(__file__),'..','data','token_cache')
 
 
 def tokenize(sentences):
 
     print 'Tokenizing..',
-    text = "\n".join(sentences)
-    tokenizer = Popen(tokenizer_cmd, stdin=PIPE, stdout=PIPE)
-    tok_text, _ = tokenizer.communicate(text)
-    toks = tok_text.split('\n')[:-1]
+    toks = moses_tokenizer.tokenize_corpus(sentences,moses_cmd,multiprocessing.cpu_count(),cache_dir=token_cache_dir)
     print 'Done'
 
     return toks
 
 
 def build_dict(path):
-    train_df = pd.read_csv(path,header = 0, index_col = 0,low_memory = False)
+    train_df = table_store.read_csv_columns(path,['cat_1','cat_2','description_clean','brand'])
 
     cat_1 = list(train_df.cat_1.astype(str))
     cat_2 = list(train_df.cat_2.astype(str))
@@ -120,7 +125,7 @@ def build_dict(path):
 
 def grab_data(path, dictionary, cat):
 
-    data = pd.read_csv(path,index_col = 0, header = 0)
+    data = table_store.read_csv_columns(path,['description_clean','brand','cat_1_num','cat_2_num','cat_3_num'])
 
     sentences = list(data.description_clean.astype(str) + 
         data.brand.astype(str))
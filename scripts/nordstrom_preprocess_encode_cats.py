@@ -1,8 +1,9 @@
 """
 This script is what created the dataset pickled.
 
-1) You need to download this file and put it in the same directory as this file.
-https://github.com/moses-smt/mosesdecoder/raw/master/scripts/tokenizer/tokenizer.perl . Give it execution permission.
+1) Descriptions are tokenized in-process by moses_tokenizer, which follows
+https://github.com/moses-smt/mosesdecoder/raw/master/scripts/tokenizer/tokenizer.perl .
+Set moses_cmd = tokenizer_cmd to run tokenizer.perl itself instead.
 
 2) Get the dataset from  and extract it in the current directory.
 
@@ -17,38 +18,47 @@ from collections import OrderedDict
 
 import glob
 import os
+import multiprocessing
 
 from subprocess import Popen, PIPE
 
 import pandas as pd
 import pdb
+import table_store
+import moses_tokenizer
+import vocab
 
 # tokenizer.perl is from Moses: https://github.com/moses-smt/mosesdecoder/tree/master/scripts/tokenizer
 tokenizer_cmd = ['./mosesdecoder/scripts/tokenizer/tokenizer.perl', '-l', 'en', '-q', '-']
+#set to tokenizer_cmd to tokenize with tokenizer.perl itself, run as parallel workers
+moses_cmd = None
+#tokenized chunks are cached here, so reruns do not tokenize the same descriptions again
+token_cache_dir = os.path.join(os.path.dirname(__file__),'..','data','token_cache')
 
 
 def tokenize(sentences):
     """
     Tokenizes sentences by removing irrelevant punctuation, etc.
-    Uses the mosesdecoder in some way.
+    Uses the in-process port of the Moses tokenizer rules, or tokenizer.perl if
+    moses_cmd is set, one output per sentence.
 
     Args:
         sentences: list of sentences
 
     Returns:
-        toks: list of tokens?
+        toks: list of tokenized sentences, aligned with sentences
     """
 
     print 'Tokenizing..',
-    text = "\n".join(sentences)
-    tokenizer = Popen(tokenizer_cmd, stdin=PIPE, stdout=PIPE)
-    tok_text, _ = tokenizer.communicate(text)
-    toks = tok_text.split('\n')[:-1]
+    toks = moses_tokenizer.tokenize_corpus(sentences,moses_cmd,multiprocessing.cpu_count(),cache_dir=token_cache_dir)
     print 'Done'
 
     return toks
 
 
+def whole_text(text):
+    return [text]
+
 def build_dict(path):
     """
     Get word counts from the descriptions
@@ -63,7 +73,7 @@ def build_dict(path):
         cat_1_dict: dict of category with counts for each
         cat_2_dict: dict of category with counts for each
     """
-    train_df = pd.read_csv(path,header = 0, index_col = 0,low_memory = False)
+    train_df = table_store.read_csv_columns(path,['cat_1','cat_2','cat_1_num','cat_2_num','description_clean','brand'])
 
     cat_1 = list(train_df.cat_1.astype(str))
     cat_2 = list(train_df.cat_2.astype(str))
@@ -81,34 +91,16 @@ def build_dict(path):
     #pdb.set_trace()
 
     print 'Getting descriptions word count..',
-    wordcount = dict()
-    for ss in descriptions:
-        words = ss.strip().lower().split()
-        
-        for w in words:
-            if w not in wordcount:
-                wordcount[w] = 1
-            else:
-                wordcount[w] += 1
+    wordcount = vocab.count_texts(descriptions,num_processes=multiprocessing.cpu_count()).counts
     print 'Done'
 
     print 'Getting cat 1 count...'
-    cat_1_count = dict()
-    for cat in cat_1:
-        if cat not in cat_1_count:
-            cat_1_count[cat] = 1
-        else:
-            cat_1_count[cat] += 1
+    cat_1_count = vocab.count_texts(cat_1,split=whole_text).counts
     print 'Done'
 
 
     print 'Getting cat 2 count...'
-    cat_2_count = dict()
-    for cat in cat_2:
-        if cat not in cat_1_count:
-            cat_2_count[cat] = 1
-        else:
-            cat_2_count[cat] += 1
+    cat_2_count = vocab.count_texts(cat_2,split=whole_text).counts
     print 'Done'
 
     #Combine dictionaries into one total count
@@ -167,7 +159,7 @@ def grab_data(path, dictionary):
         label_1, label_2, label_3: number index (not dictionary index) of the three levels of labels
     """
 
-    data = pd.read_csv(path,index_col = 0, header = 0,low_memory=False)
+    data = table_store.read_csv_columns(path,['description_clean','brand_num','cat_1_num','cat_2_num','cat_3_num'])
 
     # 'sentences' combines the description with the brand name
     #TODO: why does this often produce bigrams with periods in between?
@@ -0,0 +1,106 @@
+'''
+splits.py
+
+Deterministic split and sampling of products by a hash of their id, instead
+of permuting the whole data frame.  Every product gets
+    a split: TRAIN or VAL, from a hash of its id, so a product is on the same
+        side of the split whatever sample it is in
+    a sample rank: an independent hash of its id.  A sample of k rows is the k
+        rows with the smallest rank, so samples nest (10k in 50k in 100k), and
+        rank order is a fixed shuffle of the rows
+Both depend only on the id, so they can be worked out a block at a time while
+streaming a csv, and the same products come out on every machine and run.
+'''
+
+import hashlib
+import numpy as np
+
+TRAIN = 0
+VAL = 1
+
+SPLIT_SALT = 1
+SAMPLE_SALT = 2
+
+def mix64(x):
+    '''
+    splitmix64 finaliser of a uint64 array, wrapping on overflow
+    '''
+    x = x.copy()
+    x ^= x >> np.uint64(30)
+    x *= np.uint64(0xbf58476d1ce4e5b9)
+    x ^= x >> np.uint64(27)
+    x *= np.uint64(0x94d049bb133111eb)
+    x ^= x >> np.uint64(31)
+    return x
+
+def hash_ids(ids,salt):
+    '''
+    uint64 hash of each product id.  Integer ids are mixed vectorised; other
+    ids are hashed by their string with md5
+    args:
+        ids: array-like of product ids, e.g. df.index.values
+        salt: int, so that differently salted hashes are independent
+    '''
+    ids = np.asarray(ids)
+    if ids.dtype.kind in 'iub':
+        keys = ids.astype(np.int64).view(np.uint64)
+    else:
+        keys = np.array([int(hashlib.md5(str(i)).hexdigest()[:16],16) for i in ids],dtype=np.uint64)
+    with np.errstate(over='ignore'):
+        return mix64(keys ^ mix64(np.full(len(keys),salt,dtype=np.uint64)))
+
+def unit_interval(hashes):
+    '''
+    map uint64 hashes to floats uniform on [0, 1)
+    '''
+    return (hashes >> np.uint64(11)).astype(np.float64) / float(1<<53)
+
+def assign(ids,val_portion):
+    '''
+    split of each product id, VAL with probability val_portion, else TRAIN
+    returns:
+        (len(ids),) int8 array of TRAIN/VAL
+    '''
+    assert val_portion>=0 and val_portion<1
+    u = unit_interval(hash_ids(ids,SPLIT_SALT))
+    return np.where(u<val_portion,VAL,TRAIN).astype(np.int8)
+
+def sample_rank(ids):
+    '''
+    uint64 sample rank of each product id
+    '''
+    return hash_ids(ids,SAMPLE_SALT)
+
+def in_sample(ids,fraction):
+    '''
+    True for ids whose rank falls in the lowest fraction of the hash range.
+    Needs no count of the rows, so it works on a stream one block at a time;
+    the sample is fraction of the rows in expectation, and nests like downsample
+    '''
+    return unit_interval(sample_rank(ids))<fraction
+
+def downsample(df,samples):
+    '''
+    the samples rows of df with the smallest sample rank, in rank order.  Only
+    the rank array and the selected rows are allocated
+    args:
+        samples: number of rows, or None for all rows, still in rank order
+    '''
+    assert df.shape[0]>2
+    ranks = sample_rank(df.index.values)
+    if samples is None or samples==df.shape[0]:
+        order = np.argsort(ranks,kind='mergesort')
+    else:
+        assert 0<samples<df.shape[0]
+        order = np.argpartition(ranks,samples-1)[:samples]
+        order = order[np.argsort(ranks[order],kind='mergesort')]
+    return df.iloc[order]
+
+def split(df,val_portion):
+    '''
+    rows of df assigned TRAIN and VAL, each in df's order
+    returns:
+        trainDF, valDF
+    '''
+    is_val = assign(df.index.values,val_portion)==VAL
+    return df[~is_val], df[is_val]
@@ -4,66 +4,70 @@ Stitch separate image files together
 __author__='Charlie Guthrie'
 from utils import create_log,plog
 create_log(__file__)
-import pandas as pd
+import numpy as np
 import cPickle as pkl
 import os
+import feature_store
 
 def get_indexes(fname):
     '''
     read filename and return indexes embedded therein
+    returns (None,None) if the name does not end in _[iloc0]_[iloc1]
     '''
-    iloc0 = fname.split('.')[0].split('_')[-2]
-    iloc1 = fname.split('.')[0].split('_')[-1]
-    return int(iloc0),int(iloc1)
+    try:
+        iloc0 = fname.split('.')[0].split('_')[-2]
+        iloc1 = fname.split('.')[0].split('_')[-1]
+        return int(iloc0),int(iloc1)
+    except (IndexError,ValueError):
+        return None,None
+
+def iter_part_blocks(path):
+    '''
+    yield (row_ids, features) blocks of one part, which is either a pickled
+    DataFrame or a feature_store directory.  Only one block is in memory at a time.
+    '''
+    if feature_store.is_feature_store(path):
+        for row_ids,features in feature_store.FeatureSink(path).open_shards():
+            yield row_ids,features
+    else:
+        with open(path,'rb') as f:
+            df=pkl.load(f)
+        yield df.index.get_level_values(0).values,df.values
+        del df
 
 def stitch_files(basename,idx_start=0,idx_finish=None):
     '''
-    Cycles through all files in the basename directory and stacks them together.
+    Cycles through all files in the basename directory and copies them into one
+    preallocated, memory-mapped feature store shard.  Ranges are checked from
+    the filenames before any data is loaded, and peak memory is one part.
     args:
         basename: name without indexes, e.g. 'train_image_features'
         idx_start: starting index (usually 0)
         idx_finish: last index of the output file
     returns:
-        none.  saves pickle of images stitched together
-        
+        none.  saves feature store datadir/[basename]_[idx_start]_[idx_finish]/
+
     '''
     #datadir = '../data/'
     datadir = '/scratch/cdg356/spring/data/'
     featuredir = datadir+basename+'/'
-    
-    #Get list of indexes
-    iloc0_list = []
-    iloc1_list = []
-    for root, dirs, files in os.walk(featuredir):
-        for fname in files:
-            idx_range = get_indexes(fname)
-            if idx_range[0] is not None and idx_range[1] is not None:
-                if idx_range[0]>=idx_start and idx_range[1]<=idx_finish:
-                    iloc0_list.append(idx_range[0])
-                    iloc1_list.append(idx_range[1])
-    iloc0_list.sort()
-    iloc1_list.sort()
 
-    #Make sure there are no duplicates present
-    assert len(iloc0_list)==len(set(iloc0_list))
+    #Get list of indexes. Parts are pickles or feature store directories
+    parts = {}
+    for fname in os.listdir(featuredir):
+        idx_range = get_indexes(fname)
+        if idx_range[0] is not None and idx_range[1] is not None:
+            if idx_range[0]>=idx_start and (idx_finish is None or idx_range[1]<=idx_finish):
+                #Make sure there are no duplicates present
+                assert idx_range[0] not in parts, "duplicate parts starting at %i" %idx_range[0]
+                parts[idx_range[0]] = (idx_range[1],fname)
+    iloc0_list = sorted(parts)
+    iloc1_list = [parts[iloc0][0] for iloc0 in iloc0_list]
     assert len(iloc1_list)==len(set(iloc1_list))
 
     #Make sure there are no gaps, i.e. that iloc1 of one file = iloc0 of the next
     for i in range(len(iloc0_list)-1):
         assert iloc0_list[i+1]==iloc1_list[i]
-
-    #Load files
-    for i,iloc0 in enumerate(iloc0_list):
-        iloc1=iloc1_list[i]
-        fname = basename + "_%i_%i.pkl" %(iloc0,iloc1)
-        plog("loading %s..." %fname)
-        with open(featuredir + fname,'rb') as f:
-            if i==0:
-                df=pkl.load(f)
-            else:
-                df2=pkl.load(f)
-                df=pd.concat([df,df2])
-        plog("df shape: %s" %str(df.shape))
     max_index = max(iloc1_list)
 
     # A couple sanity checks
@@ -71,13 +75,31 @@ def stitch_files(basename,idx_start=0,idx_finish=None):
     if idx_finish is not None:
         assert idx_finish==max_index
     assert idx_start==iloc0_list[0]
-    
-    outname = datadir + basename + '_%i_%i.pkl'%(idx_start,max_index)
+
+    outname = datadir + basename + '_%i_%i'%(idx_start,max_index)
+    sink = feature_store.FeatureSink(outname)
+    assert not sink.shards, "%s already exists" %outname
+    row_ids = None
+    out = None
+
+    #Copy parts in
+    for iloc0 in iloc0_list:
+        iloc1,fname = parts[iloc0]
+        plog("loading %s..." %fname)
+        pos = iloc0 - idx_start
+        for block_row_ids,features in iter_part_blocks(featuredir + fname):
+            if out is None:
+                plog("allocating %i x %i output in %s..." %(max_index-idx_start,features.shape[1],outname))
+                out = sink.allocate(idx_start,max_index,features.shape[1])
+                row_ids = np.zeros(max_index-idx_start,dtype=np.asarray(block_row_ids).dtype)
+            out[pos:pos+features.shape[0]] = features
+            row_ids[pos:pos+features.shape[0]] = block_row_ids
+            pos += features.shape[0]
+        assert pos==iloc1-idx_start, "%s has %i rows, expected %i" %(fname,pos-(iloc0-idx_start),iloc1-iloc0)
 
     plog("writing to %s..." %outname)
-    with open(outname,'wb') as f:
-        pkl.dump(df,f)
-        
+    sink.commit_allocated(row_ids,out,idx_start,max_index)
+
 
 if __name__ == '__main__':
     stitch_files('train_image_features',0,200000)
@@ -0,0 +1,194 @@
+'''
+table_store.py
+
+Columnar copy of a catalogue csv (train_set.csv, test_set.csv), made once so
+that loaders read only the columns they use instead of parsing the whole csv.
+The store for data/train_set.csv is the directory data/train_set_columns/
+    table.json: source csv size and mtime, row count, index name and per
+        column its name and kind
+    index.npy: the csv's index column
+    c[i].npy: column i if it is numeric or bool, with its parsed dtype
+    c[i]_codes.npy: int32 dictionary codes of string column i, -1 for missing
+    c[i]_strings.bin, c[i]_offsets.npy: its dictionary, the distinct values
+        back to back with their (n+1,) int64 offsets
+    c[i]_objects.pkl: the dictionary of a column of mixed types instead
+'''
+
+import os
+import shutil
+import json
+import cPickle as pkl
+import numpy as np
+import pandas as pd
+from utils import plog
+
+def store_path(csv_path):
+    return os.path.splitext(csv_path)[0] + '_columns/'
+
+def save_column(path,stem,values):
+    '''
+    save one column as stem.npy, or dictionary encoded.
+    returns:
+        kind: 'array', 'strings' or 'objects'
+    '''
+    values = np.asarray(values)
+    if values.dtype.kind in 'biuf':
+        np.save(path + stem + '.npy',values)
+        return 'array'
+    codes,uniques = pd.factorize(values)
+    np.save(path + stem + '_codes.npy',codes.astype(np.int32))
+    uniques = list(uniques)
+    if not all(isinstance(u,str) for u in uniques):
+        with open(path + stem + '_objects.pkl','wb') as f:
+            pkl.dump(uniques,f,-1)
+        return 'objects'
+    offsets = np.zeros(len(uniques)+1,dtype=np.int64)
+    np.cumsum([len(u) for u in uniques],out=offsets[1:])
+    with open(path + stem + '_strings.bin','wb') as f:
+        f.write(''.join(uniques))
+    np.save(path + stem + '_offsets.npy',offsets)
+    return 'strings'
+
+def load_dictionary(path,stem,kind):
+    if kind=='objects':
+        with open(path + stem + '_objects.pkl','rb') as f:
+            return pkl.load(f)
+    with open(path + stem + '_strings.bin','rb') as f:
+        blob = f.read()
+    offsets = np.load(path + stem + '_offsets.npy')
+    return [blob[offsets[i]:offsets[i+1]] for i in xrange(len(offsets)-1)]
+
+def load_column(path,stem,kind,as_categorical=False):
+    '''
+    values of one column.  Dictionary encoded columns come back as object
+    arrays with NaN for missing values, like read_csv gives, or as a
+    pd.Categorical if as_categorical
+    '''
+    if kind=='array':
+        return np.load(path + stem + '.npy')
+    codes = np.load(path + stem + '_codes.npy')
+    dictionary = load_dictionary(path,stem,kind)
+    if as_categorical:
+        return pd.Categorical.from_codes(codes,dictionary)
+    #the extra NaN on the end is what code -1 picks
+    lookup = np.empty(len(dictionary)+1,dtype=object)
+    lookup[:-1] = dictionary
+    lookup[-1] = np.nan
+    return lookup[codes]
+
+def convert_csv(csv_path,path=None):
+    '''
+    one-time conversion of csv_path to a column store.  The store is written
+    under a temporary name and renamed into place.  Several jobs may convert
+    the same csv at once: a store that is already current is kept and the
+    temporary copy dropped, and a stale store is only moved aside by rename,
+    so a store another job is loading is never deleted under it
+    returns:
+        store directory
+    '''
+    if path is None:
+        path = store_path(csv_path)
+    plog("Converting %s to column store %s..." %(csv_path,path))
+    df = pd.read_csv(csv_path,header = 0, index_col = 0,low_memory = False)
+    tmp = path.rstrip('/') + '.tmp%i/' %os.getpid()
+    os.makedirs(tmp)
+    table = {'n_rows':df.shape[0],'index_name':df.index.name,'columns':[],
+             'index_kind':save_column(tmp,'index',df.index.values)}
+    for i,name in enumerate(df.columns):
+        table['columns'].append([name,save_column(tmp,'c%i' %i,df[name].values)])
+    st = os.stat(csv_path)
+    table['source_size'] = st.st_size
+    table['source_mtime'] = st.st_mtime
+    with open(tmp + 'table.json','w') as f:
+        json.dump(table,f)
+    install_store(tmp,path,csv_path)
+    return path
+
+def install_store(tmp,path,csv_path):
+    '''
+    rename the finished store tmp to path, unless another job has already put
+    a current store there, in which case tmp is removed
+    '''
+    while True:
+        if is_current(path,csv_path):
+            #another job converted the csv first
+            shutil.rmtree(tmp)
+            return
+        try:
+            os.rename(tmp.rstrip('/'),path.rstrip('/'))
+            return
+        except OSError:
+            pass
+        if is_current(path,csv_path):
+            #another job renamed its store in first
+            continue
+        #path holds a store of an older csv
+        stale = path.rstrip('/') + '.stale%i' %os.getpid()
+        try:
+            os.rename(path.rstrip('/'),stale)
+        except OSError:
+            #another job moved it first
+            continue
+        if is_current(stale + '/',csv_path):
+            #it became current after the check above; put it back
+            try:
+                os.rename(stale,path.rstrip('/'))
+            except OSError:
+                pass
+            else:
+                continue
+        shutil.rmtree(stale)
+
+def read_table_info(path):
+    with open(path + 'table.json') as f:
+        return json.load(f)
+
+def is_current(path,csv_path):
+    '''
+    True if the store at path exists and was made from the csv as it is now.
+    A store whose csv has been deleted is taken as current
+    '''
+    if not os.path.exists(path + 'table.json'):
+        return False
+    if not os.path.exists(csv_path):
+        return True
+    try:
+        table = read_table_info(path)
+    except IOError:
+        #another job moved a stale store aside since the check above
+        return False
+    st = os.stat(csv_path)
+    return table['source_size']==st.st_size and table['source_mtime']==st.st_mtime
+
+def load_table(path,columns=None,as_categorical=False):
+    '''
+    data frame of the given columns of a column store, indexed like the csv.
+    Only those columns' files are read
+    args:
+        columns: list of column names, or None for all of them
+        as_categorical: if True, string columns are pd.Categorical
+    '''
+    table = read_table_info(path)
+    kinds = dict((name,(i,kind)) for i,(name,kind) in enumerate(table['columns']))
+    if columns is None:
+        columns = [name for name,kind in table['columns']]
+    missing = [name for name in columns if name not in kinds]
+    assert not missing, "%s has no columns %s" %(path,missing)
+
+    index = pd.Index(load_column(path,'index',table['index_kind']),name=table['index_name'])
+    data = {}
+    for name in columns:
+        i,kind = kinds[name]
+        data[name] = load_column(path,'c%i' %i,kind,as_categorical)
+    return pd.DataFrame(data,index=index,columns=columns)
+
+def read_csv_columns(csv_path,columns=None,as_categorical=False):
+    '''
+    drop-in for pd.read_csv(csv_path,header=0,index_col=0,low_memory=False)
+    that converts the csv to a column store the first time (and again if the
+    csv changes) and reads only the given columns from it
+    '''
+    path = store_path(csv_path)
+    if not is_current(path,csv_path):
+        convert_csv(csv_path,path)
+    return load_table(path,columns,as_categorical)
@@ -0,0 +1,150 @@
+'''
+vocab.py
+
+Word counts that can be built per shard, merged and updated as new products
+arrive, instead of recounting the whole train csv in a dict loop each time.
+A WordCounts holds, per word, how often it occurs and in how many documents.
+Saved, it is one .npz:
+    strings: the words sorted, utf-8 encoded back to back, as uint8
+    offsets: (n+1,) int64 start of each word in strings
+    counts, doc_counts: (n,) int64
+    n_docs: number of documents counted
+'''
+
+import heapq
+import multiprocessing
+import numpy as np
+
+def lower_split(text):
+    '''
+    words of a text as the build_dict loops split them
+    '''
+    return text.strip().lower().split()
+
+class WordCounts(object):
+    '''
+    mergeable word and document counts
+    '''
+    def __init__(self,counts=None,doc_counts=None,n_docs=0):
+        self.counts = counts if counts is not None else {}
+        self.doc_counts = doc_counts if doc_counts is not None else {}
+        self.n_docs = n_docs
+
+    def __len__(self):
+        return len(self.counts)
+
+    def update(self,texts,split=lower_split):
+        '''
+        add the words of more documents
+        args:
+            texts: iterable of strings
+            split: function from a text to its list of words
+        returns:
+            self
+        '''
+        counts = self.counts
+        doc_counts = self.doc_counts
+        for text in texts:
+            words = split(text)
+            for w in words:
+                counts[w] = counts.get(w,0) + 1
+            for w in set(words):
+                doc_counts[w] = doc_counts.get(w,0) + 1
+            self.n_docs += 1
+        return self
+
+    def merge(self,other):
+        '''
+        add the counts of another WordCounts, e.g. of another shard
+        returns:
+            self
+        '''
+        for table,other_table in [(self.counts,other.counts),(self.doc_counts,other.doc_counts)]:
+            for w,c in other_table.iteritems():
+                table[w] = table.get(w,0) + c
+        self.n_docs += other.n_docs
+        return self
+
+    def most_common(self,k=None):
+        '''
+        (word, count) pairs by descending count, ties by word.  The top k are
+        picked with a heap, without sorting the whole table
+        '''
+        key = lambda wc: (-wc[1],wc[0])
+        if k is None or k>=len(self.counts):
+            return sorted(self.counts.iteritems(),key=key)
+        return heapq.nsmallest(k,self.counts.iteritems(),key=key)
+
+    def prune(self,k):
+        '''
+        WordCounts of only the k most common words
+        '''
+        words = [w for w,c in self.most_common(k)]
+        return WordCounts(dict((w,self.counts[w]) for w in words),
+                          dict((w,self.doc_counts.get(w,0)) for w in words),self.n_docs)
+
+    def word_index(self,k=None,start=1):
+        '''
+        dict of word to index, start for the most common word and up
+        '''
+        return dict((w,i) for i,(w,c) in enumerate(self.most_common(k),start))
+
+    def save(self,path):
+        '''
+        write the counts as a sorted string table plus count arrays to path (.npz)
+        '''
+        words = sorted(self.counts)
+        encoded = [w.encode('utf-8') if isinstance(w,unicode) else w for w in words]
+        offsets = np.zeros(len(words)+1,dtype=np.int64)
+        np.cumsum([len(w) for w in encoded],out=offsets[1:])
+        with open(path,'wb') as f:
+            np.savez(f,
+                     strings=np.frombuffer(''.join(encoded),dtype=np.uint8),
+                     offsets=offsets,
+                     counts=np.array([self.counts[w] for w in words],dtype=np.int64),
+                     doc_counts=np.array([self.doc_counts.get(w,0) for w in words],dtype=np.int64),
+                     n_docs=np.array(self.n_docs,dtype=np.int64))
+
+    @classmethod
+    def load(cls,path):
+        with np.load(path) as f:
+            blob = f['strings'].tostring()
+            offsets = f['offsets']
+            counts = f['counts'].tolist()
+            doc_counts = f['doc_counts'].tolist()
+            n_docs = int(f['n_docs'])
+        words = [blob[offsets[i]:offsets[i+1]] for i in xrange(len(offsets)-1)]
+        return cls(dict(zip(words,counts)),dict(zip(words,doc_counts)),n_docs)
+
+def _count_chunk(args):
+    texts,split = args
+    return WordCounts().update(texts,split)
+
+def count_texts(texts,split=lower_split,num_processes=1,chunk_size=50000):
+    '''
+    WordCounts of texts, counted in chunks of chunk_size across num_processes
+    worker processes and merged.  split must be a module-level function when
+    num_processes is more than 1, so it can be sent to the workers
+    '''
+    texts = list(texts)
+    if num_processes<=1 or len(texts)<=chunk_size:
+        return WordCounts().update(texts,split)
+    chunks = [(texts[start:start+chunk_size],split) for start in range(0,len(texts),chunk_size)]
+    pool = multiprocessing.Pool(num_processes)
+    try:
+        total = WordCounts()
+        for counts in pool.imap_unordered(_count_chunk,chunks):
+            total.merge(counts)
+    finally:
+        pool.close()
+        pool.join()
+    return total
+
+def merge_files(paths):
+    '''
+    WordCounts of several saved shards, merged
+    '''
+    total = WordCounts()
+    for path in paths:
+        total.merge(WordCounts.load(path))
+    return total